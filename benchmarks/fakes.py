@@ -0,0 +1,265 @@
+"""Local stand-ins for Slack, the chat model and Google Sheets
+
+They let the pipeline run end to end without credentials or network, with
+deterministic data and a configurable model latency.
+"""
+
+import hashlib
+import random
+import re
+import threading
+import time
+
+from langchain_core.runnables import RunnableLambda
+
+from src.scheduler import SlackScheduler
+from src.schemas import (
+    RULE_FIELDS,
+    Candidate,
+    Data,
+    PackedData,
+    ReducedCandidate,
+    ReducedData,
+    TaggedCandidate,
+)
+
+FIRST_NAMES = ["Ana", "Juan", "Maria", "Ivan", "Sofia", "Carlos", "Laura", "Diego"]
+LAST_NAMES = ["Higuera", "Mendieta", "Rojas", "Lopez", "Burke", "Garcia", "Chen"]
+UNIVERSITIES = [
+    "Universidad de los Andes",
+    "Stanford University",
+    "University of Chicago",
+    "Universidad Nacional de Colombia",
+]
+
+
+class FakeResponse:
+    """Minimal `SlackResponse` with the `data` attribute used by the bot"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+
+class FakeSlackClient:
+    """Slack client returning paginated synthetic candidate emails
+
+    Every channel has `messages_per_channel` messages, newest first, as returned by
+    `conversations_history`. `oldest`, `latest` and `cursor` are honored, so incremental syncs
+    behave like with Slack. With `thread_every` set, every `thread_every`-th message
+    starts a thread of `replies_per_thread` follow-ups.
+    """
+
+    def __init__(
+        self,
+        messages_per_channel,
+        user_id="U06N7CSQQKZ",
+        seed=0,
+        thread_every=0,
+        replies_per_thread=2,
+    ):
+        self.messages_per_channel = messages_per_channel
+        self.user_id = user_id
+        self.seed = seed
+        self.thread_every = thread_every
+        self.replies_per_thread = replies_per_thread
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def message(self, channel, idx):
+        """The `idx`-th synthetic message of a channel"""
+        rng = random.Random(f"{self.seed}-{channel}-{idx}")
+        name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+        university = rng.choice(UNIVERSITIES)
+        text = (
+            f"Dear Prof. Burke, my name is {name} and I study economics at "
+            f"{university}. I am writing to apply to the research assistant position. "
+            f"I attach my CV. Best, {name}. {name.split()[0].lower()}{idx}@example.com "
+            + "Lorem ipsum dolor sit amet. " * rng.randint(2, 20)
+        )
+        ts = 1700000000 + idx * 60 + rng.randint(0, 59)
+        message = {
+            "type": "message",
+            "user": self.user_id,
+            "text": text,
+            "ts": f"{ts}.{rng.randint(0, 999999):06d}",
+            "client_msg_id": f"{channel}-{idx}",
+            "team": "T0",
+        }
+
+        if self.thread_every and idx % self.thread_every == 0:
+            replies = self.replies(channel, idx, message["ts"])
+            message["thread_ts"] = message["ts"]
+            message["reply_count"] = len(replies)
+            message["latest_reply"] = replies[-1]["ts"]
+
+        return message
+
+    def replies(self, channel, idx, thread_ts):
+        """The synthetic follow-ups of the thread of the `idx`-th message"""
+        return [
+            {
+                "type": "message",
+                "user": self.user_id,
+                "text": f"Following up, see the updated CV in thread ({reply})",
+                "ts": f"{float(thread_ts) + 10 * (reply + 1):.6f}",
+                "thread_ts": thread_ts,
+                "client_msg_id": f"{channel}-{idx}-{reply}",
+                "team": "T0",
+            }
+            for reply in range(self.replies_per_thread)
+        ]
+
+    def conversations_history(
+        self, channel, oldest="0", cursor=None, limit=200, latest=None
+    ):
+        with self._lock:
+            self.calls += 1
+
+        # Newest messages first, like Slack, the cursor counts the messages skipped
+        idx = self.messages_per_channel - 1 - int(cursor or 0)
+        while (
+            latest is not None
+            and idx >= 0
+            and float(self.message(channel, idx)["ts"]) >= float(latest)
+        ):
+            idx -= 1
+
+        page = []
+        while idx >= 0 and len(page) < limit:
+            message = self.message(channel, idx)
+            if float(message["ts"]) <= float(oldest or 0):
+                idx = -1
+                break
+            page.append(message)
+            idx -= 1
+
+        next_cursor = str(self.messages_per_channel - 1 - idx) if idx >= 0 else ""
+        return FakeResponse(
+            {
+                "ok": True,
+                "messages": page,
+                "has_more": bool(next_cursor),
+                "response_metadata": {"next_cursor": next_cursor},
+            }
+        )
+
+    def conversations_replies(self, channel, ts, oldest="0", cursor=None, limit=200):
+        with self._lock:
+            self.calls += 1
+
+        idx = next(
+            idx
+            for idx in range(self.messages_per_channel)
+            if self.message(channel, idx)["ts"] == ts
+        )
+        parent = self.message(channel, idx)
+        replies = [
+            reply
+            for reply in self.replies(channel, idx, ts)
+            if float(reply["ts"]) > float(oldest or 0)
+        ]
+        return FakeResponse({"ok": True, "messages": [parent] + replies})
+
+
+class UnthrottledScheduler(SlackScheduler):
+    """Scheduler without rate limits, the fake client has none"""
+
+    def _interval(self, method):
+        return 0
+
+
+def fake_candidate(text, message_id=None):
+    """Deterministic candidate extracted from a text"""
+    digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+    name = re.search(r"my name is ([^.]+?) and", text)
+    email = re.search(r"\S+@\S+\.com", text)
+    fields = {
+        "name": name.group(1) if name else None,
+        "undergraduate_institution": None,
+        "graduate_institution": None,
+        "program_major": "Economics",
+        "advisor": None,
+        "current_workplace": None,
+        "current_project_name": None,
+        "email": email.group(0) if email else None,
+        "quality_assessment": str(int(digest[:2], 16) % 11),
+        "overall_summary": text[:80],
+    }
+    if message_id is None:
+        return Candidate(**fields)
+    return TaggedCandidate(**fields, message_id=message_id)
+
+
+class FakeChatModel:
+    """Chat model answering structured output calls after a fixed latency
+
+    Only `with_structured_output` is implemented, which is what the extractor uses.
+    The latency of every call is kept in `latencies`.
+    """
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def _respond(self, prompt_value, schema):
+        start = time.perf_counter()
+        time.sleep(self.latency)
+        text = prompt_value.to_messages()[-1].content
+
+        if schema is PackedData:
+            emails = re.findall(r'<email id="([^"]+)">\n(.*?)\n</email>', text, re.S)
+            output = PackedData(
+                people=[
+                    fake_candidate(email, message_id) for message_id, email in emails
+                ]
+            )
+        elif schema is ReducedData:
+            candidate = fake_candidate(text).dict(exclude=set(RULE_FIELDS))
+            output = ReducedData(people=[ReducedCandidate(**candidate)])
+        else:
+            output = Data(people=[fake_candidate(text)])
+
+        with self._lock:
+            self.latencies.append(time.perf_counter() - start)
+        return output
+
+    def with_structured_output(self, schema, **kwargs):
+        return RunnableLambda(lambda prompt_value: self._respond(prompt_value, schema))
+
+
+class FakeWorksheet:
+    """In-memory gspread worksheet supporting the calls of the spreadsheet sync"""
+
+    def __init__(self):
+        self.rows = []
+        self.calls = 0
+
+    def clear(self):
+        self.calls += 1
+        self.rows = []
+
+    def update(self, range_name, values, **kwargs):
+        self.calls += 1
+        start = int(range_name[1:])
+        while len(self.rows) < start - 1 + len(values):
+            self.rows.append([])
+        for idx, row in enumerate(values):
+            self.rows[start - 1 + idx] = list(row)
+        return {}
+
+    def append_rows(self, values, **kwargs):
+        self.calls += 1
+        start = len(self.rows) + 1
+        self.rows.extend(list(row) for row in values)
+        end = start + len(values) - 1
+        return {"updates": {"updatedRange": f"Sheet1!A{start}:Z{end}"}}
+
+    def batch_update(self, data, **kwargs):
+        self.calls += 1
+        for update in data:
+            self.rows[int(update["range"][1:]) - 1] = list(update["values"][0])
+        return {}
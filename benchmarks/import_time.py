@@ -0,0 +1,73 @@
+"""Measure the import time of the bot against a startup budget
+
+Imports `echolab_candidates_bot` in a fresh interpreter with `-X importtime`,
+with dummy tokens and a temporary database so no credentials are needed, and
+reports the total time and the slowest modules. Exits with an error if the
+import takes longer than the budget, so slow imports at startup are caught
+before deploy.
+
+Usage, from the root of the repository:
+
+    python -m benchmarks.import_time --budget 1.0
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+
+def measure_import(module):
+    """Import a module in a new interpreter and parse the `-X importtime` report
+
+    Returns:
+        list: `(cumulative_seconds, module)` of every imported module
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {
+            **os.environ,
+            "SLACK_API_TOKEN": "xoxb-benchmark",
+            "SLACK_BOT_TOKEN": "xapp-benchmark",
+            "BOT_DB_PATH": os.path.join(tmp, "bench.db"),
+        }
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:") :].split("|")
+        timings.append((int(cumulative_us) / 1e6, name.strip()))
+
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--module", default="echolab_candidates_bot")
+    parser.add_argument("--budget", type=float, default=1.0, help="Seconds")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    timings = measure_import(args.module)
+    total = next(seconds for seconds, name in timings if name == args.module)
+
+    # Only top-level packages, their cumulative time includes the submodules
+    top_level = [(seconds, name) for seconds, name in timings if "." not in name]
+    print(f"import {args.module}: {total:.3f}s (budget {args.budget:.3f}s)")
+    for seconds, name in sorted(top_level, reverse=True)[: args.top]:
+        print(f"  {seconds:.3f}s {name}")
+
+    if total > args.budget:
+        sys.exit(f"Import time over budget: {total:.3f}s > {args.budget:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
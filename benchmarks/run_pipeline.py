@@ -0,0 +1,167 @@
+"""Benchmark the bot pipeline offline
+
+Drives `retrieve_channels` -> `parsing_messages` -> spreadsheet sync against the
+fakes in `benchmarks/fakes.py` and reports throughput, p50/p99 latency of the
+model calls and peak RSS. Every size runs in its own process so the peak RSS of
+one size doesn't leak into the next.
+
+Usage, from the root of the repository:
+
+    python -m benchmarks.run_pipeline --sizes 1000 10000 100000 --latency 0.02
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+CHANNEL_IDS = ["C06PSDC08AX", "C06Q5A168DP", "C06PRB2EX61"]
+POSTER_IDS = ["U06N7CSQQKZ"]
+
+
+def percentile(values, q):
+    """Nearest-rank percentile"""
+    if not values:
+        return None
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))
+    return values[idx]
+
+
+def run_size(size, latency, max_concurrency, packed, deduplicate=False):
+    """Run the pipeline over `size` messages and return its measurements"""
+    from benchmarks.fakes import (
+        FakeChatModel,
+        FakeSlackClient,
+        FakeWorksheet,
+        UnthrottledScheduler,
+    )
+    from src.database_manager import DatabaseManager
+    from src.extractor import Extractor
+    from src.retrieve_messages import parsing_messages, retrieve_channels
+    from src.utils import send_messages_to_google_spreadsheet
+
+    per_channel = -(-size // len(CHANNEL_IDS))
+    client = FakeSlackClient(per_channel)
+    llm = FakeChatModel(latency=latency)
+    extractor = Extractor("data/examples.json", llm=llm)
+    worksheet = FakeWorksheet()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, "bench.db"))
+        stages = {}
+
+        start = time.perf_counter()
+        retrieve_channels(
+            client,
+            CHANNEL_IDS,
+            db=db,
+            filter_users=POSTER_IDS,
+            scheduler=UnthrottledScheduler(),
+        )
+        stages["retrieve"] = time.perf_counter() - start
+
+        with db.connect() as conn:
+            start = time.perf_counter()
+            parsing_messages(
+                conn,
+                max_concurrency=max_concurrency,
+                use_cache=False,
+                packed=packed,
+                attachments=False,
+                extractor=extractor,
+                deduplicate=deduplicate,
+            )
+            stages["parse"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            send_messages_to_google_spreadsheet(None, conn, worksheet=worksheet)
+            stages["sheet"] = time.perf_counter() - start
+
+            messages = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+        db.close()
+
+    total = sum(stages.values())
+    return {
+        "size": size,
+        "messages": messages,
+        "seconds": stages,
+        "throughput_msg_s": messages / total if total else None,
+        "llm_calls": len(llm.latencies),
+        "llm_p50_s": percentile(llm.latencies, 50),
+        "llm_p99_s": percentile(llm.latencies, 99),
+        "slack_calls": client.calls,
+        "sheet_calls": worksheet.calls,
+        "sheet_rows": len(worksheet.rows),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="Seconds per model call"
+    )
+    parser.add_argument("--max-concurrency", type=int, default=16)
+    parser.add_argument("--packed", action="store_true", help="Use packed extraction")
+    # Off by default: the fake emails share a template, so most of them would be
+    # linked as duplicates and skip the extraction being measured
+    parser.add_argument(
+        "--deduplicate", action="store_true", help="Link near-duplicate messages"
+    )
+    parser.add_argument("--single", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        result = run_size(
+            args.single,
+            args.latency,
+            args.max_concurrency,
+            args.packed,
+            args.deduplicate,
+        )
+        print(json.dumps(result))
+        return
+
+    for size in args.sizes:
+        command = [
+            sys.executable,
+            "-m",
+            "benchmarks.run_pipeline",
+            "--single",
+            str(size),
+            "--latency",
+            str(args.latency),
+            "--max-concurrency",
+            str(args.max_concurrency),
+        ]
+        if args.packed:
+            command.append("--packed")
+        if args.deduplicate:
+            command.append("--deduplicate")
+
+        output = subprocess.run(
+            command, check=True, capture_output=True, text=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+
+        stages = ", ".join(
+            f"{name} {secs:.2f}s" for name, secs in result["seconds"].items()
+        )
+        print(
+            f"{result['size']:>7} messages | {result['throughput_msg_s']:.1f} msg/s | "
+            f"{result['llm_calls']} llm calls, "
+            f"p50 {result['llm_p50_s'] * 1000:.1f}ms p99 {result['llm_p99_s'] * 1000:.1f}ms | "
+            f"peak RSS {result['peak_rss_mb']:.0f}MB | {stages}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,25 @@
+import functools
+import json
 import logging
 import os
-import sqlite3
+import re
+import threading
 
-import pandas as pd
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 from slack_sdk import WebClient
-from tqdm import tqdm
 from dotenv import load_dotenv
 
 
-from src.retrieve_messages import parsing_messages, retrieve_messages
-from src.utils import send_messages_to_google_spreadsheet
+# Only light modules are imported at startup so the bot connects right away after
+# a restart. pandas, LangChain, gspread and the rest of the pipeline are imported
+# by the handlers that need them, and warmed up in the background once connected.
+from src.database_manager import DatabaseManager
+from src.jobs import JobRunner
+from src.metrics import metrics, summarize_metrics
+from src.scheduler import SlackScheduler
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
 
 # Set up the Slack client and Bolt app
 
@@ -23,7 +29,49 @@ load_dotenv()
 slack_token = os.getenv("SLACK_API_TOKEN")
 slack_bot_token = os.getenv("SLACK_BOT_TOKEN")
 client = WebClient(token=slack_token)
-bolt_app = App(token=slack_token)
+# The token is verified on the first request instead of blocking the startup
+bolt_app = App(token=slack_token, token_verification_enabled=False)
+
+DB_PATH = os.getenv(
+    "BOT_DB_PATH", "/home/topcat/projects/python_slack_bot/data/slackbot_messages.db"
+)
+CREDENTIALS_PATH = "/home/topcat/projects/python_slack_bot/creds.json"
+SAVE_DATA = "/home/topcat/projects/python_slack_bot/data/downloads"
+CHANNEL_IDS = ["C06PSDC08AX", "C06Q5A168DP", "C06PRB2EX61"]
+POSTER_IDS = ["U06N7CSQQKZ", "WBA9HFDCL"]
+# Ollama model asked about the messages the pre-classifier is unsure of
+CLASSIFIER_MODEL = os.getenv("CLASSIFIER_MODEL")
+db = DatabaseManager(DB_PATH)
+scheduler = SlackScheduler()
+jobs = JobRunner()
+
+# Only one job parses messages at a time, so no message is sent twice to the LLM
+parsing_lock = threading.Lock()
+# Only one job writes the spreadsheet at a time, so no row is appended twice
+sheet_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def get_downloader():
+    """Downloader of the attachments, shared by all the jobs"""
+    from src.downloader import AttachmentDownloader
+
+    return AttachmentDownloader(SAVE_DATA)
+
+
+@functools.lru_cache(maxsize=None)
+def get_classifier():
+    """Pre-classifier of the messages, shared by all the jobs"""
+    from src.classifier import MessageClassifier
+
+    return MessageClassifier(local_model=CLASSIFIER_MODEL)
+
+
+def warm_up():
+    """Import the heavy pipeline modules so the first command doesn't wait for them"""
+    import pandas  # noqa: F401
+    import src.retrieve_messages  # noqa: F401
+    import src.utils  # noqa: F401
 
 
 @bolt_app.event("app_mention")
@@ -54,24 +102,55 @@ def event_test(say):
     )
 
 
+@bolt_app.event("message")
+def message_event(event):
+    """Save new candidate posts as they arrive and queue them for extraction
+
+    Only posts of the observed posters in the observed channels are kept. `/reload`
+    is still there to backfill the history or repair missed events.
+    """
+    if event.get("channel") not in CHANNEL_IDS:
+        return
+
+    from src.retrieve_messages import ingest_message
+
+    with db.connect() as conn:
+        saved = ingest_message(
+            event,
+            event["channel"],
+            db_conn=conn,
+            messages_table="messages",
+            save_data=SAVE_DATA,
+            filter_users=POSTER_IDS,
+            download=True,
+            downloader=get_downloader(),
+        )
+
+    if saved:
+        jobs.submit("extraction", run_extraction, rerun=True)
+
+
 @bolt_app.command("/summary")
-def summary_command(say, ack):
-    ack("Querying database... 👨🏽‍💻")
+def summary_command(say, ack, command):
+    """Count the candidates, e.g. `/summary institution quality:high`"""
+    import pandas as pd
 
-    conn = sqlite3.connect(
-        "/home/topcat/projects/python_slack_bot/data/slackbot_messages.db"
-    )
+    from src.summary import parse_summary_query, summarize
 
-    query = """
-        WITH table_group AS (
-        SELECT pm.name, pm.undergraduate_institution, pm.graduate_institution, pm.program_major, pm.advisor, pm.current_workplace, pm.current_project_name, pm.email, pm.quality_assessment, pm.overall_summary, c.channel_name, pm.ts, m.file_1, m.file_2, m.file_3, m.file_4, m.file_5
-        FROM parsed_messages pm
-        LEFT JOIN channels c ON pm.channel_id = c.channel_id
-        LEFT JOIN messages m ON pm.ts = m.ts
-        ) select channel_name, count(name) as count from table_group group by channel_name order by 2;
-        """
+    try:
+        by, filters = parse_summary_query(command.get("text", ""))
+    except ValueError as e:
+        ack(
+            f"{e}. Usage: `/summary [channel|institution|quality|week] "
+            "[channel:<name>] [institution:<words>] [quality:<low|medium|high>] "
+            "[week:<YYYY-MM-DD>] [since:<YYYY-MM-DD>]`"
+        )
+        return
+
+    ack("Querying database... 👨🏽‍💻")
 
-    df = pd.read_sql_query(query, conn)
+    with db.connect() as conn:
+        df = pd.DataFrame(summarize(conn, by, filters), columns=[by, "count"])
 
     # Send message to Slacks
     say(
@@ -85,7 +164,7 @@ def summary_command(say, ack):
                             "elements": [
                                 {
                                     "type": "text",
-                                    "text": "Number of candidates by type:\n\n",
+                                    "text": f"Number of candidates by {by}:\n\n",
                                 }
                             ],
                         },
@@ -105,43 +184,451 @@ def summary_command(say, ack):
     )
 
 
-@bolt_app.command("/reload")
-def reload_command(say, ack):
-    channel_ids = ["C06PSDC08AX", "C06Q5A168DP", "C06PRB2EX61"]
-    poster_ids = ["U06N7CSQQKZ", "WBA9HFDCL"]
-    save_data = "/home/topcat/projects/python_slack_bot/data/downloads"
+# Number of candidates shown per page of `/search` results
+SEARCH_PAGE_SIZE = 5
 
-    conn = sqlite3.connect(
-        "/home/topcat/projects/python_slack_bot/data/slackbot_messages.db"
-    )
-    """Reload database to include new candidates in channel"""
-    ack("Loading database... 👨🏽‍💻")
-    # Retrieve messages from the channel
-    for channel_id in tqdm(channel_ids, desc="Retrieving messages from channels"):
-        retrieve_messages(
+
+def search_message(query, page=0):
+    """Block Kit message with a page of search results and buttons to paginate"""
+    from src.search import search_candidates
+
+    with db.connect() as conn:
+        found = search_candidates(conn, query, page=page, page_size=SEARCH_PAGE_SIZE)
+
+    total = found["total"]
+    if not total:
+        return {"text": f"No candidates found for `{query}`"}
+
+    pages = (total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    blocks = [
+        {
+            "type": "section",
+            "text": {
+                "type": "mrkdwn",
+                "text": f"*{total}* results for `{query}` (page {page + 1} of {pages})",
+            },
+        },
+        {"type": "divider"},
+    ]
+
+    for result in found["results"]:
+        details = [
+            result["undergraduate_institution"],
+            result["graduate_institution"],
+            f"advisor {result['advisor']}" if result["advisor"] else None,
+            result["current_workplace"],
+        ]
+        lines = [
+            f"*{result['name'] or 'Unparsed message'}*"
+            + (f" · {result['email']}" if result["email"] else ""),
+            " · ".join(detail for detail in details if detail),
+            f">{result['snippet']}" if result["snippet"] else "",
+        ]
+        blocks.append(
+            {
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": "\n".join(line for line in lines if line),
+                },
+            }
+        )
+        blocks.append(
+            {
+                "type": "context",
+                "elements": [
+                    {
+                        "type": "mrkdwn",
+                        "text": f"#{result['channel_name']} · <!date^{int(float(result['ts']))}^{{date_short}}|{result['ts']}>",
+                    }
+                ],
+            }
+        )
+
+    buttons = []
+    if page > 0:
+        buttons.append(
+            {
+                "type": "button",
+                "action_id": "search_previous",
+                "text": {"type": "plain_text", "text": "‹ Previous"},
+                "value": json.dumps({"query": query, "page": page - 1}),
+            }
+        )
+    if page + 1 < pages:
+        buttons.append(
+            {
+                "type": "button",
+                "action_id": "search_next",
+                "text": {"type": "plain_text", "text": "Next ›"},
+                "value": json.dumps({"query": query, "page": page + 1}),
+            }
+        )
+    if buttons:
+        blocks.append({"type": "actions", "elements": buttons})
+
+    return {"text": f"{total} results for {query}", "blocks": blocks}
+
+
+@bolt_app.command("/search")
+def search_command(ack, respond, command):
+    """Search the candidates and the emails, e.g. `/search advisor Burke`"""
+    query = command.get("text", "").strip()
+    if not query:
+        ack(
+            "Usage: `/search <words>`, e.g. `/search Universidad de los Andes`. Start "
+            "with a field (`name`, `email`, `advisor`, `university`, `major`, "
+            "`workplace`, `project`) to search only that field."
+        )
+        return
+
+    ack()
+    respond(**search_message(query))
+
+
+@bolt_app.action(re.compile("^search_(previous|next)$"))
+def search_page_action(ack, action, respond):
+    """Show another page of search results in place"""
+    ack()
+    value = json.loads(action["value"])
+    respond(replace_original=True, **search_message(value["query"], value["page"]))
+
+
+def flush_metrics():
+    """Save the metrics collected by the pipeline in the database"""
+    with db.connect() as conn:
+        metrics.flush(conn)
+
+
+def run_extraction(job):
+    """Parse the new messages and push them to the spreadsheet"""
+    from src.retrieve_messages import parsing_messages
+    from src.utils import send_messages_to_google_spreadsheet
+
+    try:
+        # Parse messages, every batch is saved in the database as it is done
+        with parsing_lock, db.connect() as conn:
+            job.report("parsing messages")
+            parsing_messages(conn, classifier=get_classifier())
+
+        # Send the parsed messages in the database to Google Spreadsheet
+        with sheet_lock, db.connect() as conn:
+            job.report("updating spreadsheet")
+            send_messages_to_google_spreadsheet(
+                credentials=CREDENTIALS_PATH,
+                conn=conn,
+            )
+    finally:
+        flush_metrics()
+
+
+def run_reload(job):
+    """Retrieve, parse and push the new candidates to the spreadsheet"""
+    from src.retrieve_messages import retrieve_channels
+
+    # Retrieve messages from all the channels concurrently
+    job.report("retrieving messages")
+    try:
+        retrieve_channels(
             client,
-            channel_id,
-            filter_users=poster_ids,
-            save_data=save_data,
-            db_conn=conn,
+            CHANNEL_IDS,
+            db=db,
             messages_table="messages",
+            filter_users=POSTER_IDS,
+            save_data=SAVE_DATA,
+            download=True,
+            downloader=get_downloader(),
+            scheduler=scheduler,
+        )
+    finally:
+        flush_metrics()
+
+    run_extraction(job)
+
+
+def slack_progress(channel_id, message_ts):
+    """Listener keeping a Slack message updated with the progress of a job"""
+
+    def update(job):
+        if job.state == "done":
+            text = "Database reloaded successfully! 🚀"
+        elif job.state == "failed":
+            text = f"Reload failed 💥 {job.error}"
+        else:
+            text = f"Loading database... 👨🏽‍💻 {job.describe()}"
+
+        scheduler.call(
+            "chat.update",
+            client.chat_update,
+            channel=channel_id,
+            ts=message_ts,
+            text=text,
+        )
+
+    return update
+
+
+@bolt_app.command("/stats")
+def stats_command(say, ack):
+    """Show where the pipeline spent its time and how many tokens and calls it used"""
+    ack("Querying metrics... 👨🏽‍💻")
+
+    import pandas as pd
+
+    with db.connect() as conn:
+        df = pd.DataFrame(summarize_metrics(conn, days=7))
+
+    if df.empty:
+        say(text="No metrics recorded in the last 7 days")
+        return
+
+    say(
+        {
+            "blocks": [
+                {
+                    "type": "rich_text",
+                    "elements": [
+                        {
+                            "type": "rich_text_section",
+                            "elements": [
+                                {
+                                    "type": "text",
+                                    "text": "Pipeline metrics of the last 7 days (timings in seconds):\n\n",
+                                }
+                            ],
+                        },
+                        {
+                            "type": "rich_text_preformatted",
+                            "elements": [
+                                {
+                                    "type": "text",
+                                    "text": f"{df.round(3).to_markdown(index=False)}",
+                                }
+                            ],
+                        },
+                    ],
+                }
+            ]
+        }
+    )
+
+
+@bolt_app.command("/failures")
+def failures_command(ack, say, command):
+    """Inspect or requeue the messages whose extraction failed
+
+    `/failures` lists the latest failures, `/failures requeue <ts>` makes a message
+    eligible for extraction again and `/failures requeue all` requeues all of them.
+    `/failures reclassify <ts>` (or `all`) forgets that the pre-classifier left a
+    message out as not a candidate, so it is classified again on the next run.
+    """
+    import pandas as pd
+
+    from src.failures import FailureLedger
+
+    args = command.get("text", "").split()
+    if args and args[0] == "requeue":
+        target = args[1] if len(args) > 1 else None
+        if target is None:
+            ack("Usage: `/failures requeue <ts>` or `/failures requeue all`")
+            return
+
+        with db.connect() as conn:
+            requeued = FailureLedger(conn).requeue(None if target == "all" else target)
+        ack(f"Requeued {requeued} messages, they will be parsed on the next run")
+        return
+
+    if args and args[0] == "reclassify":
+        target = args[1] if len(args) > 1 else None
+        if target is None:
+            ack("Usage: `/failures reclassify <ts>` or `/failures reclassify all`")
+            return
+
+        from src.classifier import reset_classification
+
+        with db.connect() as conn:
+            reset = reset_classification(conn, None if target == "all" else target)
+        ack(f"Reset {reset} messages, they will be classified again on the next run")
+        return
+
+    ack("Querying failures... 👨🏽‍💻")
+    with db.connect() as conn:
+        ledger = FailureLedger(conn)
+        stats = ledger.stats()
+        df = pd.DataFrame(ledger.entries(limit=20))
+
+    if df.empty:
+        say(text="No failed extractions 🎉")
+        return
+
+    for column in ["last_failed_at", "next_attempt_at"]:
+        df[column] = pd.to_datetime(df[column], unit="s").dt.strftime("%Y-%m-%d %H:%M")
+    df["next_attempt_at"] = df["next_attempt_at"].fillna("never (dead)")
+    df["error"] = df["error"].str.slice(0, 60)
+
+    say(
+        {
+            "blocks": [
+                {
+                    "type": "rich_text",
+                    "elements": [
+                        {
+                            "type": "rich_text_section",
+                            "elements": [
+                                {
+                                    "type": "text",
+                                    "text": f"{stats['waiting']} messages waiting for a retry and {stats['dead']} dead:\n\n",
+                                }
+                            ],
+                        },
+                        {
+                            "type": "rich_text_preformatted",
+                            "elements": [
+                                {
+                                    "type": "text",
+                                    "text": f"{df.to_markdown(index=False)}",
+                                }
+                            ],
+                        },
+                    ],
+                }
+            ]
+        }
+    )
+
+
+@bolt_app.command("/duplicates")
+def duplicates_command(ack, command):
+    """Inspect or fix the links between the messages of the same candidate
+
+    `/duplicates <ts>` lists the messages linked to the candidate of a message,
+    `/duplicates unlink <ts>` makes a message its own candidate, extracted on the
+    next run, and `/duplicates link <ts> <candidate_ts>` links a message to the
+    candidate of another one. Links made by hand are never changed by the bot.
+    """
+    from src.dedup import link_message, linked_messages, unlink_message
+
+    args = command.get("text", "").split()
+    if len(args) == 2 and args[0] == "unlink":
+        with db.connect() as conn:
+            unlinked = unlink_message(conn, args[1])
+        if unlinked:
+            ack(f"Unlinked {args[1]}, it will be parsed on the next run")
+        else:
+            ack(f"{args[1]} is not linked to another message")
+        return
+
+    if len(args) == 3 and args[0] == "link":
+        with db.connect() as conn:
+            linked = link_message(conn, args[1], args[2])
+        if linked:
+            ack(f"Linked {args[1]} to the candidate of {args[2]}")
+        else:
+            ack(f"{args[1]} or {args[2]} was not indexed yet")
+        return
+
+    if len(args) != 1:
+        ack(
+            "Usage: `/duplicates <ts>`, `/duplicates unlink <ts>` or "
+            "`/duplicates link <ts> <candidate_ts>`"
         )
+        return
+
+    with db.connect() as conn:
+        rows = linked_messages(conn, args[0])
+    if not rows:
+        ack(f"{args[0]} was not indexed yet")
+        return
+
+    lines = []
+    for channel_id, ts, candidate_ts, similarity, method in rows:
+        if ts == candidate_ts:
+            how = "candidate"
+        elif similarity is not None:
+            how = f"{method}, similarity {similarity:.2f}"
+        else:
+            how = method
+        lines.append(f"{ts} in <#{channel_id}> ({how})")
+    ack(f"{len(rows)} messages of the same candidate:\n" + "\n".join(lines))
+
 
-    # Parse messages
-    parsed_messages = parsing_messages(conn)
+@bolt_app.command("/reload")
+def reload_command(ack, command):
+    """Reload database to include new candidates in channel
+
+    The reload runs in the background job runner, so the handler returns right
+    away. A reload requested while another one is running follows the run in
+    flight instead of starting a new one. `/reload status` shows the latest run.
+    """
+    if command.get("text", "").strip() == "status":
+        job = jobs.status("reload")
+        ack(job.describe() if job else "No reload has run yet")
+        return
+
+    job, created = jobs.submit("reload", run_reload)
+    if created:
+        ack("Loading database... 👨🏽‍💻")
+    else:
+        ack(f"A reload is already running, following it 👀 ({job.describe()})")
 
-    # Send parsed messages to Google Spreadsheet
-    send_messages_to_google_spreadsheet(
-        parsed_messages=parsed_messages,
-        credentials="/home/topcat/projects/python_slack_bot/creds.json",
-        conn=conn,
+    # Post a message in the invoking channel and keep it updated
+    response = scheduler.call(
+        "chat.postMessage",
+        client.chat_postMessage,
+        channel=command["channel_id"],
+        text=f"Loading database... 👨🏽‍💻 {job.describe()}",
     )
+    job.add_listener(slack_progress(response["channel"], response["ts"]))
 
-    # Send message to Slacks
-    say(text="Database reloaded successfully! 🚀")
+
+def run_resync(job):
+    """Rewrite the whole Google Spreadsheet from the database"""
+    from src.utils import send_messages_to_google_spreadsheet
+
+    with sheet_lock, db.connect() as conn:
+        job.report("rewriting spreadsheet")
+        send_messages_to_google_spreadsheet(
+            credentials=CREDENTIALS_PATH,
+            conn=conn,
+            full_resync=True,
+        )
+
+
+@bolt_app.command("/resync")
+def resync_command(say, ack):
+    """Rewrite the whole Google Spreadsheet from the database
+
+    The rewrite runs in the background job runner and waits for any update of the
+    spreadsheet in flight, so it doesn't interleave with the rows being appended.
+    """
+    job, created = jobs.submit("resync", run_resync)
+    if created:
+        ack("Rewriting the spreadsheet... 👨🏽‍💻")
+    else:
+        ack(f"A resync is already running 👀 ({job.describe()})")
+        return
+
+    notified = threading.Event()
+
+    def notify(job):
+        if job.active or notified.is_set():
+            return
+        notified.set()
+        if job.state == "done":
+            say(text="Spreadsheet rewritten from the database! 🧹")
+        else:
+            say(text=f"Resync failed 💥 {job.error}")
+
+    job.add_listener(notify)
 
 
 if __name__ == "__main__":
-    SocketModeHandler(
+    handler = SocketModeHandler(
         bolt_app, app_token=slack_bot_token, web_client=client, trace_enabled=True
-    ).start()
+    )
+
+    # Connect first, then load the heavy modules while already serving events
+    handler.connect()
+    bolt_app.logger.info("⚡️ Bolt app is running!")
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    threading.Event().wait()
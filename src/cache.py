@@ -0,0 +1,121 @@
+import hashlib
+import time
+import unicodedata
+
+from .schemas import Data
+
+
+def normalize_text(text):
+    """Normalize a message text so reposts of the same email get the same key"""
+    text = unicodedata.normalize("NFC", text or "")
+    return " ".join(text.split())
+
+
+class ExtractionCache:
+    """Cache of LLM extractions persisted in SQLite
+
+    Results are keyed by a hash of the normalized message text and the extractor
+    fingerprint (model name, schema version and examples file digest), so the same
+    email cross-posted to several channels, or parsed again, costs a single lookup.
+    Entries older than `max_age_days` are evicted, and past `max_entries` the least
+    recently used ones are dropped.
+    """
+
+    def __init__(self, conn, max_entries=10000, max_age_days=180):
+        self.conn = conn
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS extraction_cache
+            (key TEXT PRIMARY KEY, fingerprint TEXT, data TEXT, hits INT DEFAULT 0,
+            created_at REAL, last_used_at REAL)
+            """
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(text, fingerprint):
+        """Hash the normalized text together with the extractor fingerprint"""
+        content = f"{fingerprint}\n{normalize_text(text)}"
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, text, fingerprint):
+        """Get a cached extraction
+
+        Args:
+            text (str): The message text
+            fingerprint (str): The fingerprint of the extractor
+
+        Returns:
+            Data: The cached extraction, or None on a miss
+        """
+        key = self.make_key(text, fingerprint)
+        row = self.conn.execute(
+            "SELECT data FROM extraction_cache WHERE key = ?", (key,)
+        ).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.conn.execute(
+            "UPDATE extraction_cache SET hits = hits + 1, last_used_at = ? WHERE key = ?",
+            (time.time(), key),
+        )
+        self.conn.commit()
+
+        return Data.parse_raw(row[0])
+
+    def put(self, text, fingerprint, data):
+        """Save an extraction in the cache
+
+        Args:
+            text (str): The message text
+            fingerprint (str): The fingerprint of the extractor
+            data (Data): The extraction
+        """
+        now = time.time()
+        self.conn.execute(
+            """
+            INSERT OR REPLACE INTO extraction_cache
+            (key, fingerprint, data, hits, created_at, last_used_at)
+            VALUES (?, ?, ?, 0, ?, ?)
+            """,
+            (self.make_key(text, fingerprint), fingerprint, data.json(), now, now),
+        )
+        self.conn.commit()
+
+    def evict(self):
+        """Drop expired entries and the least recently used ones over the limit
+
+        Returns:
+            int: Number of entries removed
+        """
+        cutoff = time.time() - self.max_age_days * 24 * 3600
+        removed = self.conn.execute(
+            "DELETE FROM extraction_cache WHERE created_at < ?", (cutoff,)
+        ).rowcount
+
+        removed += self.conn.execute(
+            """
+            DELETE FROM extraction_cache WHERE key IN (
+                SELECT key FROM extraction_cache
+                ORDER BY last_used_at DESC
+                LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_entries,),
+        ).rowcount
+        self.conn.commit()
+
+        return removed
+
+    def stats(self):
+        """Hit and miss counters of this cache object plus its size"""
+        size = self.conn.execute("SELECT COUNT(*) FROM extraction_cache").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "size": size}
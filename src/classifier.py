@@ -0,0 +1,234 @@
+import re
+import time
+
+from .metrics import metrics
+
+
+def create_classification_table(conn):
+    """Create the table keeping the pre-classification decision of each message"""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS message_classification
+        (channel_id TEXT, ts TEXT, is_candidate INT, score REAL, method TEXT,
+        classified_at REAL, PRIMARY KEY (channel_id, ts))
+        """
+    )
+    conn.commit()
+
+
+# Weighted patterns of the emails sent by candidates
+CANDIDATE_PATTERNS = [
+    (
+        re.compile(
+            r"\b(dear|hello|hi|estimad[oa]|hola)\s+(prof|professor|profesor[a]?|dr|dra)\b",
+            re.I,
+        ),
+        0.2,
+    ),
+    (
+        re.compile(
+            r"\bmy name is\b|\bi am\b|\bi['’]m\b|\bmi nombre es\b|\bsoy\b", re.I
+        ),
+        0.15,
+    ),
+    (
+        re.compile(
+            r"\b(universi\w+|college|institut\w*|ph\.?d|master'?s|maestr[ií]a|"
+            r"bachelor'?s|pregrado|undergrad\w*|graduate|major|degree|advisor|"
+            r"econom[ií]a|doctorado)\b",
+            re.I,
+        ),
+        0.2,
+    ),
+    (
+        re.compile(
+            r"\b(research assistant\w*|(?-i:RA)|assistantship|position|opening|"
+            r"job|posting|interested|apply\w*|application|cv|resume|curriculum|"
+            r"asistente|postula\w*|hoja de vida|vacante|interesad[oa])\b",
+            re.I,
+        ),
+        0.25,
+    ),
+    (re.compile(r"[\w.+-]+@[\w-]+\.[\w.]+"), 0.1),
+]
+
+# Patterns of follow-ups and chatter, only counted in short messages without any
+# candidate pattern
+CHATTER_PATTERNS = re.compile(
+    r"\b(see thread|in thread|following up|follow up|fyi|thanks|thank you|"
+    r"forwarding|ping|bump)\b|^\s*\+1",
+    re.I,
+)
+
+CLASSIFIER_PROMPT = """Answer only "yes" or "no". Is the following message an email \
+from a person introducing themselves or applying to a position at a research lab?
+
+{text}"""
+
+
+def reset_classification(conn, ts=None):
+    """Forget the decisions of the pre-classifier, so messages are classified again
+
+    Args:
+        conn (sqlite3.Connection): The SQLite connection
+        ts (str): Slack `ts` of the message to reset, all the messages left out as
+            not candidates when None
+
+    Returns:
+        int: Number of decisions forgotten
+    """
+    create_classification_table(conn)
+    if ts is None:
+        cursor = conn.execute(
+            "DELETE FROM message_classification WHERE is_candidate = 0"
+        )
+    else:
+        cursor = conn.execute("DELETE FROM message_classification WHERE ts = ?", (ts,))
+    conn.commit()
+    return cursor.rowcount
+
+
+def heuristic_score(text):
+    """Score how likely a message is a candidate email, from 0 to 1
+
+    The score adds the weights of the candidate patterns found in the text and a
+    bonus for long messages, and penalizes short messages, and short follow-up
+    chatter such as "see thread" with nothing of a candidate email.
+
+    Args:
+        text (str): The text of the message
+
+    Returns:
+        float: The score of the message
+    """
+    text = text or ""
+    score = sum(
+        weight for pattern, weight in CANDIDATE_PATTERNS if pattern.search(text)
+    )
+
+    if len(text) >= 400:
+        score += 0.1
+    elif len(text) < 80:
+        if not score and CHATTER_PATTERNS.search(text):
+            score -= 0.3
+        score -= 0.2
+
+    return min(1.0, max(0.0, score))
+
+
+class MessageClassifier:
+    """Decide locally whether a message is a candidate email before the LLM
+
+    Messages scoring at least `high` with `heuristic_score` are candidates and
+    messages scoring below `low`, chatter with nothing of a candidate email, are
+    not. The observed channels hold almost only candidate emails, so the uncertain
+    ones in between are asked to a small local model, `local_model` served by
+    Ollama or `llm`, when one is set, and are otherwise kept as candidates so no
+    email is lost.
+
+    Args:
+        low (float): Score below which messages are not candidates
+        high (float): Minimum score of the candidate messages
+        local_model (str): Name of an Ollama model for the uncertain messages
+        llm (langchain_core.language_models.BaseLanguageModel): Model to use
+            instead of `local_model`
+    """
+
+    def __init__(self, low=0.05, high=0.6, local_model=None, llm=None):
+        self.low = low
+        self.high = high
+
+        if llm is None and local_model is not None:
+            # LangChain Community is slow to import and only used here
+            from langchain_community.llms import Ollama
+
+            llm = Ollama(model=local_model, temperature=0)
+        self.llm = llm
+
+    def _ask_model(self, text):
+        """Ask the local model whether a message is a candidate email"""
+        with metrics.timer("classifier.model"):
+            answer = self.llm.invoke(CLASSIFIER_PROMPT.format(text=text[:2000]))
+
+        answer = getattr(answer, "content", answer)
+        return answer.strip().lower().startswith("yes")
+
+    def classify(self, text, has_files=False):
+        """Classify a message
+
+        A message with files attached, often just a CV with a line of text, is never
+        discarded by the heuristic alone: at worst it is uncertain.
+
+        Args:
+            text (str): The text of the message
+            has_files (bool): Whether files are attached to the message
+
+        Returns:
+            tuple: Whether the message is a candidate email, its heuristic score and
+                the method deciding, `heuristic`, `model` or `uncertain`
+        """
+        score = heuristic_score(text)
+        if score >= self.high:
+            return True, score, "heuristic"
+        if score < self.low and not has_files:
+            return False, score, "heuristic"
+
+        if self.llm is not None:
+            try:
+                return self._ask_model(text), score, "model"
+            except Exception as e:
+                print(f"Error classifying with the local model: {e}")
+
+        return True, score, "uncertain"
+
+    def filter_candidates(self, conn, messages):
+        """Keep the candidate emails and record the decision of the new messages
+
+        Messages with a decision recorded, in the `is_candidate` column, are not
+        classified again.
+
+        Args:
+            conn (sqlite3.Connection): The SQLite connection
+            messages (pd.DataFrame): Messages with `text`, `channel_id`, `ts`,
+                `has_files` and `is_candidate` columns
+
+        Returns:
+            pd.DataFrame: The candidate messages
+        """
+        import pandas as pd
+
+        create_classification_table(conn)
+
+        decisions = []
+        keep = []
+        for text, channel_id, ts, has_files, is_candidate in zip(
+            messages["text"],
+            messages["channel_id"],
+            messages["ts"],
+            messages["has_files"],
+            messages["is_candidate"],
+        ):
+            if pd.isna(is_candidate):
+                is_candidate, score, method = self.classify(text, bool(has_files))
+                decisions.append(
+                    (channel_id, ts, int(is_candidate), score, method, time.time())
+                )
+                metrics.increment(f"classifier.{method}")
+
+            keep.append(bool(is_candidate))
+
+        conn.executemany(
+            """
+            INSERT OR REPLACE INTO message_classification
+            (channel_id, ts, is_candidate, score, method, classified_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            decisions,
+        )
+        conn.commit()
+
+        skipped = sum(1 for decision in decisions if not decision[2])
+        if skipped:
+            print(f"Skipped {skipped} messages that are not candidate emails")
+
+        return messages[keep].drop(columns=["has_files", "is_candidate"])
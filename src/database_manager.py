@@ -1,5 +1,91 @@
+import queue
 import sqlite3
-import pandas as pd
+import time
+from contextlib import contextmanager
+
+from .classifier import create_classification_table
+from .dedup import create_dedup_tables
+from .failures import create_failures_table
+from .search import create_search_index
+from .summary import create_summary_table
+
+# pandas is imported by the functions using it, the bot opens the database at
+# startup and shouldn't pay for it
+
+# Columns of the messages table, in order
+MESSAGE_COLUMNS = [
+    "text",
+    "files",
+    "upload",
+    "user",
+    "display_as_bot",
+    "type",
+    "ts",
+    "client_msg_id",
+    "team",
+    "reply_count",
+    "reply_users_count",
+    "is_locked",
+    "subscribed",
+    "channel_id",
+    "file_1",
+    "file_2",
+    "file_3",
+    "file_4",
+    "file_5",
+    "thread_ts",
+    "latest_reply",
+    "parent_ts",
+]
+
+# Columns of the parsed_messages table, in order
+PARSED_MESSAGE_COLUMNS = [
+    "name",
+    "undergraduate_institution",
+    "graduate_institution",
+    "program_major",
+    "advisor",
+    "current_workplace",
+    "current_project_name",
+    "email",
+    "quality_assessment",
+    "overall_summary",
+    "channel_id",
+    "ts",
+    "field_sources",
+]
+
+# Columns holding the `ts` of a message, with whether their table also has the
+# channel of the message, rewritten when a rounded `ts` gets its exact value
+MESSAGE_TS_COLUMNS = [
+    ("parsed_messages", "ts", True),
+    ("message_classification", "ts", True),
+    ("extraction_failures", "ts", True),
+    ("candidate_links", "ts", True),
+    ("candidate_links", "candidate_ts", False),
+    ("message_signatures", "ts", True),
+    ("lsh_buckets", "ts", True),
+    ("downloads", "message_ts", True),
+    ("sheet_sync", "ts", False),
+]
+
+
+# Slack `ts` are kept as the exact strings sent by Slack, e.g. "1712345678.123456"
+MESSAGES_TABLE = """
+    CREATE TABLE IF NOT EXISTS {table}
+    (text TEXT, files TEXT, upload TEXT, user TEXT, display_as_bot TEXT,
+    type TEXT, ts TEXT, client_msg_id TEXT, team TEXT,
+    reply_count INT, reply_users_count INT, is_locked TEXT,
+    subscribed TEXT, channel_id TEXT, file_1 TEXT, file_2 TEXT, file_3 TEXT,
+    file_4 TEXT, file_5 TEXT, thread_ts TEXT, latest_reply TEXT, parent_ts TEXT,
+    PRIMARY KEY (channel_id, ts) ON CONFLICT IGNORE)
+    """
+
+PARSED_MESSAGES_TABLE = """
+    CREATE TABLE IF NOT EXISTS {table}
+    (name TEXT, undergraduate_institution TEXT, graduate_institution TEXT, program_major TEXT,
+    advisor TEXT, current_workplace TEXT, current_project_name TEXT, email TEXT, quality_assessment TEXT, overall_summary TEXT, channel_id TEXT, ts TEXT, field_sources TEXT, PRIMARY KEY (ts) ON CONFLICT IGNORE)
+    """
 
 
 def create_database(data_path="data/slackbot_messages.db"):
@@ -7,47 +93,590 @@ def create_database(data_path="data/slackbot_messages.db"):
     conn = sqlite3.connect(data_path)
     c = conn.cursor()
 
+    create_tables(conn)
+
+    return conn, c
+
+
+def create_tables(conn):
+    """Create the tables and indexes of the bot if they don't exist"""
+    c = conn.cursor()
+
     # Create messages table if it doesn't exist
+    c.execute(MESSAGES_TABLE.format(table="messages"))
+    c.execute(PARSED_MESSAGES_TABLE.format(table="parsed_messages"))
+
+    # Columns added after the first version
+    add_missing_column(conn, "parsed_messages", "field_sources", "TEXT")
+    for column in ["thread_ts", "latest_reply", "parent_ts"]:
+        add_missing_column(conn, "messages", column, "TEXT")
+    migrate_ts_to_text(conn)
+    migrate_messages_key(conn)
+
+    # Lookups by `ts` alone (the primary key starts with the channel) and
+    # by channel
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages (ts)")
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_channel_id ON messages (channel_id)"
+    )
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_parsed_messages_channel_id ON parsed_messages (channel_id)"
+    )
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_parent_ts ON messages (parent_ts)"
+    )
+    # The messages still saved with a rounded `ts`, see `reconcile_rounded_ts`
     c.execute(
         """
-        CREATE TABLE IF NOT EXISTS messages
-        (text TEXT, files TEXT, upload TEXT, user TEXT, display_as_bot TEXT,
-        type TEXT, ts INT, client_msg_id TEXT, team TEXT, 
-        reply_count INT, reply_users_count INT, is_locked TEXT,
-        subscribed TEXT, channel_id TEXT, file_1 TEXT, file_2 TEXT, file_3 TEXT, 
-        file_4 TEXT, file_5 TEXT, PRIMARY KEY (ts, client_msg_id) ON CONFLICT IGNORE)
+        CREATE INDEX IF NOT EXISTS idx_messages_rounded_ts ON messages (channel_id, ts)
+        WHERE instr(ts, '.') = 0
         """
     )
 
+    create_sync_state_table(conn)
+    create_thread_state_table(conn)
+    create_search_index(conn)
+    create_summary_table(conn)
+    create_dedup_tables(conn)
+
+    # Lookup tables, rewritten every time like a `to_sql(if_exists="replace")`
     c.execute(
+        "CREATE TABLE IF NOT EXISTS channels (channel_id TEXT, channel_name TEXT)"
+    )
+    c.execute("DELETE FROM channels")
+    c.executemany(
+        "INSERT INTO channels (channel_id, channel_name) VALUES (?, ?)",
+        [
+            ("C06PSDC08AX", "graduate_students"),
+            ("C06Q5A168DP", "research_assistants"),
+            ("C06PRB2EX61", "visiting_scholars"),
+        ],
+    )
+
+    c.execute("CREATE TABLE IF NOT EXISTS users (user_id TEXT, user_name TEXT)")
+    c.execute("DELETE FROM users")
+    c.executemany(
+        "INSERT INTO users (user_id, user_name) VALUES (?, ?)",
+        [("U06N7CSQQKZ", "Chumi"), ("WBA9HFDCL", "Sam"), ("U023Q2A64BU", "Me")],
+    )
+
+    conn.commit()
+
+
+def add_missing_column(conn, table, column, column_type):
+    """Add a column to a table created before the column existed"""
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        conn.commit()
+
+
+def migrate_ts_to_text(conn):
+    """Change the `ts` column of databases created with an integer `ts` to text
+
+    Older versions saved `ts` rounded to an integer, which collapsed messages
+    posted in the same second. Those tables are rebuilt with a text `ts`; the rows
+    already saved keep their rounded value as text, so they still join with each
+    other, until the exact `ts` of the message is synced again
+    (`reconcile_rounded_ts`). The watermarks are left unset, so the first sync
+    requests the whole history again and backfills the messages older versions
+    missed, while the rows already saved get their exact `ts` instead of being
+    duplicated.
+    """
+    for table, ddl, columns in [
+        ("messages", MESSAGES_TABLE, MESSAGE_COLUMNS),
+        ("parsed_messages", PARSED_MESSAGES_TABLE, PARSED_MESSAGE_COLUMNS),
+    ]:
+        ts_type = next(
+            row[2]
+            for row in conn.execute(f"PRAGMA table_info({table})")
+            if row[1] == "ts"
+        )
+        if ts_type.upper() == "TEXT":
+            continue
+
+        print(f"Migrating {table}.ts to text")
+        column_list = ", ".join(columns)
+        select_list = ", ".join(
+            "CAST(ts AS TEXT)" if column == "ts" else column for column in columns
+        )
+        conn.execute(f"ALTER TABLE {table} RENAME TO {table}_int_ts")
+        conn.execute(ddl.format(table=table))
+        conn.execute(
+            f"INSERT INTO {table} ({column_list}) SELECT {select_list} FROM {table}_int_ts"
+        )
+        conn.execute(f"DROP TABLE {table}_int_ts")
+
+    conn.commit()
+
+
+def reconcile_rounded_ts(conn, keys, table="messages"):
+    """Give the messages saved with a rounded `ts` their exact `ts`
+
+    Databases migrated by `migrate_ts_to_text` keep the `ts` of older messages
+    rounded, e.g. "1712345678" for "1712345678.123456". When the exact `ts` of one
+    of them arrives, the rounded row is rewritten to it, in the messages table and
+    in every table referring to the message, instead of being saved twice. If a
+    table already has a row with the exact `ts`, the rounded one is dropped.
+
+    Args:
+        conn (sqlite3.Connection): The SQLite connection
+        keys (iterable): `(channel_id, ts)` of the messages about to be saved
+        table (str): Name of the messages table
+
+    Returns:
+        int: Number of messages reconciled
+    """
+    # Cheap with the partial index, so databases without rounded `ts` skip the lookups
+    if not conn.execute(
+        f"SELECT 1 FROM {table} WHERE instr(ts, '.') = 0 LIMIT 1"
+    ).fetchone():
+        return 0
+
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master")}
+    columns = [(table, "ts", True)] + [
+        column for column in MESSAGE_TS_COLUMNS if column[0] in tables
+    ]
+
+    reconciled = 0
+    for channel_id, ts in keys:
+        if not ts or "." not in ts:
+            continue
+        rounded = str(int(float(ts)))
+        if not conn.execute(
+            f"SELECT 1 FROM {table} WHERE channel_id = ? AND ts = ?",
+            (channel_id, rounded),
+        ).fetchone():
+            continue
+
+        for name, column, by_channel in columns:
+            where = f"{column} = ?" + (" AND channel_id = ?" if by_channel else "")
+            params = (rounded, channel_id) if by_channel else (rounded,)
+            conn.execute(
+                f"UPDATE OR IGNORE {name} SET {column} = ? WHERE {where}",
+                (ts,) + params,
+            )
+            # Left when the exact `ts` was already saved
+            if column != "candidate_ts":
+                conn.execute(f"DELETE FROM {name} WHERE {where}", params)
+        reconciled += 1
+
+    return reconciled
+
+
+def migrate_messages_key(conn):
+    """Key the messages table on `(channel_id, ts)` instead of `(ts, client_msg_id)`
+
+    SQLite never considers two NULL `client_msg_id` equal, so every save of a
+    message without one (bot posts, file shares, some replies) added another copy.
+    The table is rebuilt with the new key, keeping the latest copy of each message,
+    and the full-text index of the messages, which refers to their rowid, is
+    rebuilt.
+    """
+    key = [
+        row[1]
+        for row in sorted(
+            conn.execute("PRAGMA table_info(messages)"), key=lambda r: r[5]
+        )
+        if row[5]
+    ]
+    if key == ["channel_id", "ts"]:
+        return
+
+    print("Migrating the key of messages to (channel_id, ts)")
+    columns = ", ".join(MESSAGE_COLUMNS)
+    conn.execute("ALTER TABLE messages RENAME TO messages_old_key")
+    conn.execute(MESSAGES_TABLE.format(table="messages"))
+    conn.execute(
+        f"""
+        INSERT INTO messages ({columns})
+        SELECT {columns} FROM messages_old_key
+        WHERE rowid IN (
+            SELECT MAX(rowid) FROM messages_old_key GROUP BY channel_id, ts
+        )
         """
-        CREATE TABLE IF NOT EXISTS parsed_messages
-        (name TEXT, undergraduate_institution TEXT, graduate_institution TEXT, program_major TEXT,
-        advisor TEXT, current_workplace TEXT, current_project_name TEXT, email TEXT, quality_assessment TEXT, overall_summary TEXT, channel_id TEXT, ts INT, PRIMARY KEY (ts) ON CONFLICT IGNORE)
+    )
+    conn.execute("DROP TABLE messages_old_key")
+
+    # The triggers of the index were dropped with the old table, they are created
+    # again by `create_search_index`
+    if conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'"
+    ).fetchone():
+        conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+    conn.commit()
+
+
+def project_message(message, additional_cols=None):
+    """Project a Slack message onto the columns of the messages table
+
+    Values that are not scalars (lists and dicts such as `files` or `blocks`) are
+    left out, and `ts` is kept as the exact string sent by Slack.
+
+    Args:
+        message (dict): A message from the Slack API
+        additional_cols (dict): Additional columns to set, e.g. the `channel_id`
+
+    Returns:
+        dict: The message with exactly the columns of the messages table
+    """
+    record = {}
+    for column in MESSAGE_COLUMNS:
+        value = message.get(column)
+        record[column] = None if isinstance(value, (list, dict)) else value
+
+    if additional_cols:
+        record.update(additional_cols)
+
+    return record
+
+
+def create_sync_state_table(conn):
+    """Create the table keeping the per-channel sync watermarks
+
+    Each row stores the newest `ts` already saved for a channel (`latest_ts`), and
+    while a sync is in progress the pagination `cursor` and the newest `ts` seen so
+    far (`pending_latest_ts`), so an interrupted sync can resume where it stopped.
+    `threads_checked_at` is the time of the last look back for threads with new
+    replies.
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sync_state
+        (channel_id TEXT PRIMARY KEY, latest_ts TEXT, cursor TEXT,
+        pending_latest_ts TEXT, updated_at REAL, threads_checked_at REAL)
         """
     )
+    conn.commit()
+    add_missing_column(conn, "sync_state", "threads_checked_at", "REAL")
 
-    channels = pd.DataFrame(
-        {
-            "channel_id": ["C06PSDC08AX", "C06Q5A168DP", "C06PRB2EX61"],
-            "channel_name": [
-                "graduate_students",
-                "research_assistants",
-                "visiting_scholars",
-            ],
-        }
-    ).to_sql("channels", conn, if_exists="replace", index=False)
 
-    users = pd.DataFrame(
-        {
-            "user_id": ["U06N7CSQQKZ", "WBA9HFDCL", "U023Q2A64BU"],
-            "user_name": ["Chumi", "Sam", "Me"],
-        }
-    ).to_sql("users", conn, if_exists="replace", index=False)
+def get_sync_state(conn, channel_id):
+    """Get the sync watermark of a channel
 
-    del channels, users
+    Args:
+        conn (sqlite3.Connection): The SQLite connection
+        channel_id (str): The ID of the channel
 
-    return conn, c
+    Returns:
+        dict: The `latest_ts`, `cursor`, `pending_latest_ts` and
+        `threads_checked_at` of the channel. All values are None if the channel was
+        never synced.
+    """
+    create_sync_state_table(conn)
+
+    keys = ["latest_ts", "cursor", "pending_latest_ts", "threads_checked_at"]
+    row = conn.execute(
+        f"SELECT {', '.join(keys)} FROM sync_state WHERE channel_id = ?",
+        (channel_id,),
+    ).fetchone()
+
+    if row is None:
+        return dict.fromkeys(keys)
+
+    return dict(zip(keys, row))
+
+
+def update_sync_state(conn, channel_id, latest_ts, cursor=None, pending_latest_ts=None):
+    """Save the sync watermark of a channel
+
+    Args:
+        conn (sqlite3.Connection): The SQLite connection
+        channel_id (str): The ID of the channel
+        latest_ts (str): Newest `ts` fully synced for the channel
+        cursor (str): Pagination cursor of an unfinished sync, None once finished
+        pending_latest_ts (str): Newest `ts` seen by an unfinished sync
+    """
+    conn.execute(
+        """
+        INSERT INTO sync_state (channel_id, latest_ts, cursor, pending_latest_ts, updated_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(channel_id) DO UPDATE SET
+            latest_ts = excluded.latest_ts,
+            cursor = excluded.cursor,
+            pending_latest_ts = excluded.pending_latest_ts,
+            updated_at = excluded.updated_at
+        """,
+        (channel_id, latest_ts, cursor, pending_latest_ts, time.time()),
+    )
+    conn.commit()
+
+
+def update_threads_checked(conn, channel_id, checked_at=None):
+    """Save the time of the last look back for threads with new replies
+
+    Args:
+        conn (sqlite3.Connection): The SQLite connection
+        channel_id (str): The ID of the channel, already in `sync_state`
+        checked_at (float): Unix time of the check, now if None
+    """
+    conn.execute(
+        "UPDATE sync_state SET threads_checked_at = ? WHERE channel_id = ?",
+        (time.time() if checked_at is None else checked_at, channel_id),
+    )
+    conn.commit()
+
+
+def create_thread_state_table(conn):
+    """Create the table keeping the newest reply synced of each thread"""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS thread_state
+        (channel_id TEXT, thread_ts TEXT, latest_reply TEXT, updated_at REAL,
+        PRIMARY KEY (channel_id, thread_ts))
+        """
+    )
+    conn.commit()
+
+
+def changed_threads(conn, channel_id, threads):
+    """Get the threads with replies newer than the last thread sync
+
+    Args:
+        conn (sqlite3.Connection): The SQLite connection
+        channel_id (str): The ID of the channel
+        threads (dict): The `latest_reply` of each thread keyed by `thread_ts`, as
+            seen in the channel history
+
+    Returns:
+        dict: The `latest_reply` already synced, None for new threads, of the
+            threads whose `latest_reply` moved, keyed by `thread_ts`
+    """
+    create_thread_state_table(conn)
+
+    synced = dict(
+        conn.execute(
+            "SELECT thread_ts, latest_reply FROM thread_state WHERE channel_id = ?",
+            (channel_id,),
+        ).fetchall()
+    )
+    return {
+        thread_ts: synced.get(thread_ts)
+        for thread_ts, latest_reply in threads.items()
+        if synced.get(thread_ts) is None
+        or float(latest_reply) > float(synced[thread_ts])
+    }
+
+
+def update_thread_state(conn, channel_id, thread_ts, latest_reply):
+    """Save the newest reply synced of a thread"""
+    conn.execute(
+        """
+        INSERT INTO thread_state (channel_id, thread_ts, latest_reply, updated_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(channel_id, thread_ts) DO UPDATE SET
+            latest_reply = excluded.latest_reply,
+            updated_at = excluded.updated_at
+        """,
+        (channel_id, thread_ts, latest_reply, time.time()),
+    )
+    conn.commit()
+
+
+def upsert_messages(conn, records, chunk_size=500, table="messages"):
+    """Insert or update messages with a prepared statement
+
+    Only the columns of the messages table are taken from each record, missing ones
+    are saved as NULL. A message already saved gets its mutable fields (text, reply
+    counts and files) updated.
+
+    Args:
+        conn (sqlite3.Connection): The SQLite connection
+        records (iterable): Messages as dicts
+        chunk_size (int): Number of messages written per `executemany` call
+        table (str): Name of the messages table
+
+    Returns:
+        int: Number of messages written
+    """
+    columns = ", ".join(MESSAGE_COLUMNS)
+    placeholders = ", ".join("?" for _ in MESSAGE_COLUMNS)
+    updates = ", ".join(
+        f"{column} = excluded.{column}"
+        for column in MESSAGE_COLUMNS
+        if column not in ("ts", "channel_id")
+    )
+    query = f"""
+        INSERT INTO {table} ({columns}) VALUES ({placeholders})
+        ON CONFLICT(channel_id, ts) DO UPDATE SET {updates}
+        """
+
+    ts_index = MESSAGE_COLUMNS.index("ts")
+    channel_index = MESSAGE_COLUMNS.index("channel_id")
+
+    def write(chunk):
+        reconcile_rounded_ts(
+            conn, [(row[channel_index], row[ts_index]) for row in chunk], table
+        )
+        conn.executemany(query, chunk)
+
+    written = 0
+    chunk = []
+    for record in records:
+        chunk.append(tuple(record.get(column) for column in MESSAGE_COLUMNS))
+        if len(chunk) >= chunk_size:
+            write(chunk)
+            written += len(chunk)
+            chunk = []
+
+    if chunk:
+        write(chunk)
+        written += len(chunk)
+
+    conn.commit()
+    return written
+
+
+def insert_parsed_messages(conn, records):
+    """Insert parsed messages, ignoring the ones already saved
+
+    Args:
+        conn (sqlite3.Connection): The SQLite connection
+        records (iterable): Parsed messages as dicts
+
+    Returns:
+        int: Number of parsed messages inserted
+    """
+    columns = ", ".join(PARSED_MESSAGE_COLUMNS)
+    placeholders = ", ".join("?" for _ in PARSED_MESSAGE_COLUMNS)
+
+    cursor = conn.executemany(
+        f"INSERT OR IGNORE INTO parsed_messages ({columns}) VALUES ({placeholders})",
+        [
+            tuple(record.get(column) for column in PARSED_MESSAGE_COLUMNS)
+            for record in records
+        ],
+    )
+    conn.commit()
+    return cursor.rowcount
+
+
+def select_unparsed_messages(conn, limit=None, after=None):
+    """Get the messages that have not been parsed yet
+
+    Messages the pre-classifier decided are not candidate emails are left out, and
+    so are the messages whose extraction failed until their next retry is due and
+    the duplicates of a candidate already parsed.
+
+    Args:
+        conn (sqlite3.Connection): The SQLite connection
+        limit (int): Maximum number of messages returned, all of them when None
+        after (tuple): Only the messages after this `(ts, channel_id)`, to read
+            them in batches without scanning the messages of the previous batches
+            again
+
+    Returns:
+        pd.DataFrame: The `text`, `channel_id` and `ts` of the unparsed messages,
+            whether they have files attached, `has_files`, and `is_candidate`,
+            NULL if they were not classified yet, in `ts` order so they are always
+            read, and linked to their candidate, in the same order
+    """
+    import pandas as pd
+
+    create_classification_table(conn)
+    create_failures_table(conn)
+    create_dedup_tables(conn)
+
+    return pd.read_sql_query(
+        """
+        SELECT m.text, m.channel_id, m.ts, m.file_1 IS NOT NULL AS has_files,
+            mc.is_candidate
+        FROM messages m
+        LEFT JOIN parsed_messages pm ON pm.ts = m.ts
+        LEFT JOIN message_classification mc
+            ON mc.channel_id = m.channel_id AND mc.ts = m.ts
+        LEFT JOIN extraction_failures f ON f.channel_id = m.channel_id AND f.ts = m.ts
+        LEFT JOIN candidate_links l ON l.channel_id = m.channel_id AND l.ts = m.ts
+        LEFT JOIN parsed_messages cpm ON cpm.ts = l.candidate_ts
+        WHERE (m.ts, m.channel_id) > (?, ?) AND pm.ts IS NULL
+            AND (mc.is_candidate IS NULL OR mc.is_candidate = 1)
+            AND (f.ts IS NULL OR f.next_attempt_at <= ?) AND cpm.ts IS NULL
+        ORDER BY m.ts, m.channel_id
+        LIMIT ?
+        """,
+        conn,
+        params=(*(after or ("", "")), time.time(), -1 if limit is None else limit),
+    )
+
+
+class DatabaseManager:
+    """Own the SQLite database of the bot
+
+    Connections are opened once in Write-Ahead Logging mode and kept in a pool, so
+    readers don't block the writer and the slash commands and worker threads reuse
+    them instead of opening a new connection each time. The tables and indexes are
+    created when the manager is created.
+
+    Args:
+        data_path (str): Path to the SQLite database
+        pool_size (int): Maximum number of idle connections kept open
+        timeout (float): Seconds to wait for a lock held by another connection
+    """
+
+    def __init__(self, data_path="data/slackbot_messages.db", pool_size=4, timeout=30):
+        self.data_path = data_path
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+        with self.connect() as conn:
+            create_tables(conn)
+
+    def _open(self):
+        """Open a new connection in WAL mode"""
+        conn = sqlite3.connect(
+            self.data_path, timeout=self.timeout, check_same_thread=False
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def connect(self):
+        """Borrow a connection from the pool
+
+        The transaction is committed when the block ends, or rolled back if it
+        raises, and the connection goes back to the pool.
+        """
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._open()
+
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def close(self):
+        """Close the idle connections of the pool"""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def upsert_messages(self, records, chunk_size=500):
+        """Insert or update messages, see `upsert_messages`"""
+        with self.connect() as conn:
+            return upsert_messages(conn, records, chunk_size=chunk_size)
+
+    def insert_parsed_messages(self, records):
+        """Insert parsed messages, see `insert_parsed_messages`"""
+        with self.connect() as conn:
+            return insert_parsed_messages(conn, records)
+
+    def unparsed_messages(self):
+        """Get the messages that have not been parsed yet"""
+        with self.connect() as conn:
+            return select_unparsed_messages(conn)
 
 
 def structure_messages(messages, additional_cols=None):
@@ -60,28 +689,9 @@ def structure_messages(messages, additional_cols=None):
     Returns:
         pd.DataFrame: A DataFrame of messages
     """
-    cols_with_non_serials = [
-        "files",
-        "edited",
-        "blocks",
-        "thread_ts",
-        "reply_users",
-        "latest_reply",
-        "subtype",
-        "name",
-        "attachments",
-        "old_name",
-    ]
+    import pandas as pd
 
-    df = pd.DataFrame(messages)
-    df = df.drop(columns=cols_with_non_serials, errors="ignore")
-
-    # Convert timestamp to integer for ease
-    df["ts"] = df["ts"].astype(float).astype(int)
-
-    # Add additional columns if provided
-    if additional_cols:
-        for col, data in additional_cols.items():
-            df[col] = data
-
-    return df
+    return pd.DataFrame(
+        [project_message(message, additional_cols) for message in messages],
+        columns=MESSAGE_COLUMNS,
+    )
@@ -0,0 +1,454 @@
+import re
+import time
+import unicodedata
+import zlib
+
+import numpy as np
+
+from .metrics import metrics
+
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+# Modulus of the hash functions of the signatures, a Mersenne prime
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+def create_dedup_tables(conn):
+    """Create the tables linking near-duplicate messages to a candidate
+
+    `candidate_links` maps every message to its candidate, the first message of
+    the same person that was indexed, `message_signatures` keeps the MinHash signature
+    and the name and emails of each message, and `lsh_buckets` is the LSH index of
+    the signatures, one row per band.
+    """
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS candidate_links
+        (channel_id TEXT, ts TEXT, candidate_ts TEXT, similarity REAL, method TEXT,
+        linked_at REAL, PRIMARY KEY (channel_id, ts));
+        CREATE INDEX IF NOT EXISTS idx_candidate_links_candidate_ts
+            ON candidate_links (candidate_ts);
+
+        CREATE TABLE IF NOT EXISTS message_signatures
+        (channel_id TEXT, ts TEXT, name_key TEXT, email_key TEXT, signature BLOB,
+        rule_email_key TEXT, PRIMARY KEY (channel_id, ts));
+        CREATE INDEX IF NOT EXISTS idx_message_signatures_ts
+            ON message_signatures (ts);
+        CREATE INDEX IF NOT EXISTS idx_message_signatures_email_key
+            ON message_signatures (email_key);
+
+        CREATE TABLE IF NOT EXISTS lsh_buckets
+        (band INT, bucket INT, channel_id TEXT, ts TEXT,
+        PRIMARY KEY (band, bucket, channel_id, ts)) WITHOUT ROWID;
+        """
+    )
+
+    # Column added after the first version
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(message_signatures)")]
+    if "rule_email_key" not in columns:
+        conn.execute("ALTER TABLE message_signatures ADD COLUMN rule_email_key TEXT")
+    conn.commit()
+
+
+def name_key(name):
+    """Normalize a name to compare it, e.g. "Iván  Higuera" -> "higuera ivan" """
+    if not name:
+        return None
+    name = unicodedata.normalize("NFKD", name)
+    name = "".join(char for char in name if not unicodedata.combining(char))
+    words = sorted(WORD_PATTERN.findall(name.casefold()))
+    return " ".join(words) or None
+
+
+def email_key(email):
+    """Normalize an email address to compare it"""
+    return (email.strip().lower() or None) if email else None
+
+
+def linked_messages(conn, ts):
+    """The messages linked to the same candidate as a message
+
+    Args:
+        conn (sqlite3.Connection): The SQLite connection
+        ts (str): The `ts` of the message
+
+    Returns:
+        list: `(channel_id, ts, candidate_ts, similarity, method)` of each message,
+            oldest first
+    """
+    return conn.execute(
+        """
+        SELECT l.channel_id, l.ts, l.candidate_ts, l.similarity, l.method
+        FROM candidate_links l
+        WHERE l.candidate_ts = (SELECT candidate_ts FROM candidate_links WHERE ts = ?)
+        ORDER BY l.ts
+        """,
+        (ts,),
+    ).fetchall()
+
+
+def unlink_message(conn, ts):
+    """Make a message its own candidate, so it is extracted on the next run
+
+    Args:
+        conn (sqlite3.Connection): The SQLite connection
+        ts (str): The `ts` of the message
+
+    Returns:
+        int: Number of messages unlinked
+    """
+    cursor = conn.execute(
+        """
+        UPDATE candidate_links
+        SET candidate_ts = ts, similarity = NULL, method = 'manual', linked_at = ?
+        WHERE ts = ? AND candidate_ts != ts
+        """,
+        (time.time(), ts),
+    )
+    conn.commit()
+    return cursor.rowcount
+
+
+def link_message(conn, ts, candidate_ts):
+    """Link a message to the candidate of another message
+
+    Links made by hand are kept by `CandidateDeduplicator.link`, and the messages
+    already linked to the message stay linked to it.
+
+    Args:
+        conn (sqlite3.Connection): The SQLite connection
+        ts (str): The `ts` of the message
+        candidate_ts (str): The `ts` of a message of the candidate
+
+    Returns:
+        int: Number of messages linked, 0 if either message is not indexed
+    """
+    row = conn.execute(
+        "SELECT candidate_ts FROM candidate_links WHERE ts = ?", (candidate_ts,)
+    ).fetchone()
+    if row is None:
+        return 0
+
+    cursor = conn.execute(
+        """
+        UPDATE candidate_links
+        SET candidate_ts = ?, similarity = NULL, method = 'manual', linked_at = ?
+        WHERE ts = ?
+        """,
+        (row[0], time.time(), ts),
+    )
+    conn.commit()
+    return cursor.rowcount
+
+
+class CandidateDeduplicator:
+    """Link near-duplicate messages from the same person to a single candidate
+
+    The same person often writes several times, or to several channels, with a
+    slightly different wording. Every message gets a MinHash signature of its word
+    shingles, computed with NumPy, whose agreement estimates the Jaccard similarity
+    of two texts. The signatures are indexed in SQLite with LSH: split in `bands`,
+    two messages sharing the hash of a band are compared, and linked when their
+    similarity is at least `threshold` and their names and emails don't differ.
+    Messages with the same email and no different name are linked whatever their
+    text. The address found by the rules may be the recipient's, so it never links
+    messages, but two different ones mean two people.
+
+    Args:
+        conn (sqlite3.Connection): The SQLite connection
+        num_perm (int): Number of hash functions of the signatures
+        bands (int): Number of LSH bands, a divisor of `num_perm`. Messages are
+            compared when they share a band, so with `r = num_perm / bands` rows per
+            band the similarity found about half the time is `(1 / bands) ** (1 / r)`,
+            0.71 with the defaults, close to `threshold`
+        threshold (float): Minimum estimated similarity of near duplicates
+        shingle_size (int): Number of words of each shingle
+        max_candidates (int): Maximum number of indexed messages compared to a new
+            one, those sharing the most bands
+        bucket_limit (int): Maximum number of messages read from each LSH bucket
+        seed (int): Seed of the hash functions, fixed so signatures are comparable
+            across runs
+    """
+
+    def __init__(
+        self,
+        conn,
+        num_perm=128,
+        bands=16,
+        threshold=0.7,
+        shingle_size=3,
+        max_candidates=10,
+        bucket_limit=10,
+        seed=1,
+    ):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+
+        self.conn = conn
+        self.num_perm = num_perm
+        self.bands = bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.max_candidates = max_candidates
+        self.bucket_limit = bucket_limit
+
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self._band_weights = rng.integers(1, 1 << 63, num_perm // bands, np.uint64) | 1
+
+        create_dedup_tables(conn)
+
+    def shingles(self, text):
+        """Hashes of the word shingles of a text"""
+        words = WORD_PATTERN.findall((text or "").lower())
+        if not words:
+            return np.zeros(0, dtype=np.uint64)
+
+        hashes = np.array(
+            [zlib.crc32(word.encode()) for word in words], dtype=np.uint64
+        )
+        size = min(self.shingle_size, len(hashes))
+
+        # Polynomial hash of each run of `size` words
+        shingles = np.zeros(len(hashes) - size + 1, dtype=np.uint64)
+        for offset in range(size):
+            shingles = (
+                shingles * np.uint64(1000003) + hashes[offset : len(shingles) + offset]
+            )
+        return np.unique(shingles % np.uint64(MERSENNE_PRIME))
+
+    def signatures(self, texts):
+        """MinHash signatures of texts
+
+        Args:
+            texts (iterable): The texts
+
+        Returns:
+            list: The `uint32` array of `num_perm` values of each text, None for the
+                texts without words
+        """
+        signatures = []
+        for text in texts:
+            shingles = self.shingles(text)
+            if not len(shingles):
+                signatures.append(None)
+                continue
+
+            # Every hash function applied to every shingle at once
+            hashed = (self._a[:, None] * shingles[None, :] + self._b[:, None]) % (
+                MERSENNE_PRIME
+            )
+            signatures.append(hashed.min(axis=1).astype(np.uint32))
+
+        return signatures
+
+    def band_buckets(self, signature):
+        """LSH bucket of each band of a signature, as signed 64-bit integers"""
+        rows = signature.astype(np.uint64).reshape(self.bands, -1)
+        return (rows * self._band_weights).sum(axis=1).view(np.int64)
+
+    def _find(self, signature, name, email, rule_email):
+        """Find the candidate of a message among the indexed messages
+
+        Returns:
+            tuple: The `ts` of the candidate, the similarity and the method, or None
+        """
+        # A different name or email, of the message or of its candidate, means a
+        # different person, e.g. two candidates writing to the same professor
+        same_person = """
+            (?1 IS NULL OR s.name_key IS NULL OR s.name_key = ?1)
+            AND (?1 IS NULL OR c.name_key IS NULL OR c.name_key = ?1)
+            AND (?2 IS NULL OR s.email_key IS NULL OR s.email_key = ?2)
+            AND (?2 IS NULL OR c.email_key IS NULL OR c.email_key = ?2)
+            AND (?3 IS NULL OR s.rule_email_key IS NULL OR s.rule_email_key = ?3)
+            AND (?3 IS NULL OR c.rule_email_key IS NULL OR c.rule_email_key = ?3)
+            """
+
+        # An email shared by several candidates, e.g. the professor's, is ambiguous
+        if email is not None:
+            rows = self.conn.execute(
+                f"""
+                SELECT DISTINCT l.candidate_ts
+                FROM message_signatures s
+                JOIN candidate_links l ON l.channel_id = s.channel_id AND l.ts = s.ts
+                LEFT JOIN message_signatures c ON c.ts = l.candidate_ts
+                WHERE s.email_key = ?2 AND {same_person}
+                LIMIT 2
+                """,
+                (name, email, rule_email),
+            ).fetchall()
+            if len(rows) == 1:
+                return rows[0][0], 1.0, "email"
+
+        if signature is None:
+            return None
+
+        # Each band reads at most `bucket_limit` messages, so the buckets of a
+        # template many people copy don't make every lookup slower, and only the
+        # messages sharing the most bands are compared. Both are ordered, so the same
+        # messages are always linked the same way
+        probes = " UNION ALL ".join(
+            f"""
+            SELECT * FROM (
+                SELECT channel_id, ts FROM lsh_buckets
+                WHERE band = {band} AND bucket = ?{5 + band}
+                ORDER BY channel_id, ts
+                LIMIT {self.bucket_limit}
+            )
+            """
+            for band in range(self.bands)
+        )
+        rows = self.conn.execute(
+            f"""
+            WITH hits AS (
+                SELECT channel_id, ts, COUNT(*) AS shared
+                FROM ({probes})
+                GROUP BY channel_id, ts
+            )
+            SELECT s.signature, l.candidate_ts
+            FROM hits
+            JOIN message_signatures s ON s.channel_id = hits.channel_id AND s.ts = hits.ts
+            JOIN candidate_links l ON l.channel_id = s.channel_id AND l.ts = s.ts
+            LEFT JOIN message_signatures c ON c.ts = l.candidate_ts
+            WHERE {same_person}
+            ORDER BY hits.shared DESC, hits.ts, hits.channel_id
+            LIMIT ?4
+            """,
+            [name, email, rule_email, self.max_candidates]
+            + self.band_buckets(signature).tolist(),
+        ).fetchall()
+
+        if not rows:
+            return None
+
+        others = np.stack([np.frombuffer(row[0], dtype=np.uint32) for row in rows])
+        similarities = (others == signature).mean(axis=1)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+
+        return rows[best][1], float(similarities[best]), "minhash"
+
+    def link(self, keys, texts, fields):
+        """Link messages to their candidate, indexing them for the next messages
+
+        Messages already linked keep their candidate. The others are linked to the
+        candidate of their nearest duplicate, or become a new candidate.
+
+        Args:
+            keys (list): `(channel_id, ts)` of each message
+            texts (list): The texts of the messages
+            fields (list): A dict of each message with its `name`, `email` and
+                `rule_email`, when known. The `email` links messages, so only pass
+                an email extracted by the model there: the address found by the
+                rules, `rule_email`, may be the recipient's
+
+        Returns:
+            list: The `ts` of the candidate of each message
+        """
+        linked = (
+            dict(
+                ((channel_id, ts), candidate_ts)
+                for channel_id, ts, candidate_ts in self.conn.execute(
+                    f"""
+                WITH batch (channel_id, ts) AS (VALUES {", ".join("(?, ?)" for _ in keys)})
+                SELECT l.channel_id, l.ts, l.candidate_ts
+                FROM batch b
+                JOIN candidate_links l ON l.channel_id = b.channel_id AND l.ts = b.ts
+                """,
+                    [value for key in keys for value in key],
+                )
+            )
+            if keys
+            else {}
+        )
+
+        new = [idx for idx, key in enumerate(keys) if key not in linked]
+        with metrics.timer("dedup.signatures"):
+            signatures = self.signatures([texts[idx] for idx in new])
+
+        now = time.time()
+        for idx, signature in zip(new, signatures):
+            channel_id, ts = keys[idx]
+            name = name_key(fields[idx].get("name"))
+            email = email_key(fields[idx].get("email"))
+            rule_email = email_key(fields[idx].get("rule_email"))
+
+            # Linked one by one, so duplicates within the same messages are found
+            found = self._find(signature, name, email, rule_email)
+            candidate_ts, similarity, method = found or (ts, None, None)
+            if found:
+                metrics.increment(f"dedup.{method}")
+
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO candidate_links
+                (channel_id, ts, candidate_ts, similarity, method, linked_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (channel_id, ts, candidate_ts, similarity, method, now),
+            )
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO message_signatures
+                (channel_id, ts, name_key, email_key, signature, rule_email_key)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    channel_id,
+                    ts,
+                    name,
+                    email,
+                    signature.tobytes() if signature is not None else None,
+                    rule_email,
+                ),
+            )
+            if signature is not None:
+                self.conn.executemany(
+                    """
+                    INSERT OR IGNORE INTO lsh_buckets (band, bucket, channel_id, ts)
+                    VALUES (?, ?, ?, ?)
+                    """,
+                    [
+                        (band, bucket, channel_id, ts)
+                        for band, bucket in enumerate(
+                            self.band_buckets(signature).tolist()
+                        )
+                    ],
+                )
+            linked[keys[idx]] = candidate_ts
+
+        self.conn.commit()
+        return [linked[key] for key in keys]
+
+    def index_parsed(self, chunk_size=500):
+        """Index the parsed messages saved before the deduplication existed
+
+        Returns:
+            int: Number of messages indexed
+        """
+        indexed = 0
+        while True:
+            rows = self.conn.execute(
+                """
+                SELECT pm.channel_id, pm.ts, m.text, pm.name, pm.email
+                FROM parsed_messages pm
+                JOIN messages m ON m.channel_id = pm.channel_id AND m.ts = pm.ts
+                LEFT JOIN candidate_links l
+                    ON l.channel_id = pm.channel_id AND l.ts = pm.ts
+                WHERE l.ts IS NULL
+                ORDER BY CAST(pm.ts AS REAL)
+                LIMIT ?
+                """,
+                (chunk_size,),
+            ).fetchall()
+            if not rows:
+                return indexed
+
+            self.link(
+                [(channel_id, ts) for channel_id, ts, *_ in rows],
+                [row[2] for row in rows],
+                [{"name": row[3], "email": row[4]} for row in rows],
+            )
+            indexed += len(rows)
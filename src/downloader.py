@@ -0,0 +1,157 @@
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def create_downloads_table(conn):
+    """Create the manifest of the downloaded attachments"""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS downloads
+        (file_id TEXT PRIMARY KEY, size INT, path TEXT, message_ts TEXT,
+        channel_id TEXT, downloaded_at REAL)
+        """
+    )
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_downloads_message
+            ON downloads (channel_id, message_ts)
+        """
+    )
+    conn.commit()
+
+
+class AttachmentDownloader:
+    """Download Slack attachments through a shared connection pool
+
+    Files are downloaded by a bounded pool of worker threads sharing a single
+    `requests.Session`, streamed to disk in chunks through a temporary file that is
+    renamed once complete, so memory use doesn't depend on the file size and a
+    failed download never leaves a truncated file behind. The `downloads` table is
+    the manifest of the files on disk: a file whose Slack `id` and size match the
+    manifest is not downloaded again.
+
+    Args:
+        save_data (str): The path to the folder to save the files
+        token (str): Slack token, `SLACK_API_TOKEN` by default
+        max_workers (int): Maximum number of files downloaded at the same time
+        chunk_size (int): Bytes read from the response at a time
+        timeout (float): Seconds to wait for the server
+    """
+
+    def __init__(
+        self,
+        save_data="data/downloads",
+        token=None,
+        max_workers=4,
+        chunk_size=64 * 1024,
+        timeout=60,
+    ):
+        self.save_data = save_data
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+
+        # Use the token for authentication
+        token = token or os.getenv("SLACK_API_TOKEN")
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {token}"
+
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max_workers,
+            max_retries=Retry(
+                total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503]
+            ),
+        )
+        self.session.mount("https://", adapter)
+
+    def file_path(self, file):
+        """Path of a Slack file on disk"""
+        return os.path.join(self.save_data, f"{file['id']}.{file['filetype']}")
+
+    def _download(self, file):
+        """Stream a file to a temporary file and move it in place"""
+        path = self.file_path(file)
+
+        with self.session.get(
+            file["url_private"], stream=True, timeout=self.timeout
+        ) as response:
+            response.raise_for_status()
+
+            fd, tmp_path = tempfile.mkstemp(dir=self.save_data, suffix=".part")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        f.write(chunk)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+        return path
+
+    def download(self, files, db_conn):
+        """Download the files missing from the manifest
+
+        Args:
+            files (list): Slack file dicts, with the `message_ts` and `channel_id`
+                of their message added
+            db_conn (sqlite3.Connection): The SQLite connection
+
+        Returns:
+            dict: The path of every file on disk keyed by Slack file ID
+        """
+        create_downloads_table(db_conn)
+
+        paths = {}
+        missing = []
+        for file in files:
+            row = db_conn.execute(
+                "SELECT size, path FROM downloads WHERE file_id = ?", (file["id"],)
+            ).fetchone()
+            if row and row[0] == file.get("size") and os.path.exists(row[1]):
+                paths[file["id"]] = row[1]
+            elif all(file["id"] != other["id"] for other in missing):
+                missing.append(file)
+
+        if not missing:
+            return paths
+
+        # Create folder if save_data doesn't exist
+        os.makedirs(self.save_data, exist_ok=True)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._download, file): file for file in missing}
+            for future in as_completed(futures):
+                file = futures[future]
+                try:
+                    path = future.result()
+                except Exception as e:
+                    print(f"Error downloading {file['id']}: {e}")
+                    continue
+
+                paths[file["id"]] = path
+                db_conn.execute(
+                    """
+                    INSERT OR REPLACE INTO downloads
+                    (file_id, size, path, message_ts, channel_id, downloaded_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        file["id"],
+                        file.get("size"),
+                        path,
+                        file.get("message_ts"),
+                        file.get("channel_id"),
+                        time.time(),
+                    ),
+                )
+
+        db_conn.commit()
+        return paths
@@ -0,0 +1,132 @@
+import hashlib
+import os
+import re
+from collections import Counter
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    """Split a text in lowercase word tokens"""
+    return [
+        token for token in TOKEN_PATTERN.findall((text or "").lower()) if len(token) > 1
+    ]
+
+
+def index_path(examples_path):
+    """Path of the index persisted next to an examples file"""
+    return f"{os.path.splitext(examples_path)[0]}.index.npz"
+
+
+class ExampleIndex:
+    """TF-IDF index of the example texts used to pick few-shot examples
+
+    The example texts are stored as L2-normalized TF-IDF rows of a NumPy matrix, so
+    the examples most similar to an email are found with a single matrix-vector
+    product. The index is persisted next to the examples file together with the
+    digest of the file, and rebuilt only when the file changes.
+    """
+
+    def __init__(self, vocabulary, idf, matrix, digest=None):
+        self.vocabulary = {token: idx for idx, token in enumerate(vocabulary)}
+        self.idf = idf
+        self.matrix = matrix
+        self.digest = digest
+
+    @classmethod
+    def build(cls, texts, digest=None):
+        """Build the index of a list of example texts"""
+        documents = [Counter(tokenize(text)) for text in texts]
+        vocabulary = sorted(set().union(*documents)) if documents else []
+
+        index = cls(vocabulary, np.zeros(len(vocabulary)), None, digest)
+
+        # Smoothed inverse document frequency, as in scikit-learn
+        doc_freq = np.zeros(len(vocabulary))
+        for document in documents:
+            for token in document:
+                doc_freq[index.vocabulary[token]] += 1
+        index.idf = np.log((1 + len(documents)) / (1 + doc_freq)) + 1
+
+        index.matrix = index.vectorize(texts)
+        return index
+
+    @classmethod
+    def load_or_build(cls, examples_path, texts):
+        """Load the index persisted next to the examples, or build and save it
+
+        Args:
+            examples_path (str): Path to the examples file
+            texts (list): The example texts, in the order of the file
+
+        Returns:
+            ExampleIndex: The index of the examples
+        """
+        with open(examples_path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+
+        path = index_path(examples_path)
+        if os.path.exists(path):
+            saved = np.load(path)
+            if str(saved["digest"]) == digest:
+                return cls(
+                    saved["vocabulary"].tolist(), saved["idf"], saved["matrix"], digest
+                )
+
+        index = cls.build(texts, digest)
+        np.savez(
+            path,
+            vocabulary=np.array(list(index.vocabulary), dtype=str),
+            idf=index.idf,
+            matrix=index.matrix,
+            digest=np.array(digest),
+        )
+        return index
+
+    def vectorize(self, texts):
+        """Convert texts to L2-normalized TF-IDF rows"""
+        matrix = np.zeros((len(texts), len(self.vocabulary)))
+        for row, text in enumerate(texts):
+            for token, count in Counter(tokenize(text)).items():
+                col = self.vocabulary.get(token)
+                if col is not None:
+                    matrix[row, col] = count
+
+        matrix *= self.idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return matrix / norms
+
+    def select(self, text, k, token_budget=None, token_counts=None):
+        """Pick the examples most similar to a text
+
+        Args:
+            text (str): The text to extract data from
+            k (int): Maximum number of examples
+            token_budget (int): Maximum estimated tokens of the selected examples
+            token_counts (list): Estimated tokens of each example
+
+        Returns:
+            list: Indices of the selected examples, in the order of the file
+        """
+        if self.matrix is None or self.matrix.shape[0] == 0:
+            return []
+
+        scores = self.matrix @ self.vectorize([text])[0]
+
+        # Stable sort so ties keep the order of the file
+        ranked = np.argsort(-scores, kind="stable")
+
+        selected, used = [], 0
+        for idx in ranked:
+            if len(selected) >= k:
+                break
+            tokens = token_counts[idx] if token_counts is not None else 0
+            if token_budget is not None and selected and used + tokens > token_budget:
+                continue
+            selected.append(int(idx))
+            used += tokens
+
+        return sorted(selected)
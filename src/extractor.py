@@ -1,6 +1,11 @@
+import hashlib
+import os
+import threading
+import time
 import uuid
 from typing import List
 
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain_core.messages import (
     AIMessage,
     BaseMessage,
@@ -10,11 +15,46 @@ from langchain_core.messages import (
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_openai import ChatOpenAI
 
-from .schemas import Example, Data
+from .example_index import ExampleIndex
+from .metrics import metrics
+from .schemas import (
+    RULE_FIELDS,
+    SCHEMA_VERSION,
+    Example,
+    Data,
+    PackedData,
+    ReducedCandidate,
+    ReducedData,
+    TaggedCandidate,
+)
 from .utils import load_examples
 
 
-def tool_example_to_messages(example: Example) -> List[BaseMessage]:
+SYSTEM_PROMPT = (
+    "You are an expert email extraction algorithm and an HR manager "
+    "You watn to pick the best candidates for a new position."
+    "Only extract relevant information from the text. "
+    "If you do not know the value of an attribute asked "
+    "to extract, return null for the attribute's value."
+)
+
+PACKED_PROMPT = (
+    "You will receive several emails, each one wrapped in an <email id=...> tag. "
+    "Extract exactly one candidate per email and set its message_id to the id "
+    "of the email it was extracted from."
+)
+
+REDUCED_PROMPT = (
+    "The name of the candidate is already known, extract only the other " "attributes."
+)
+
+# Namespace of the tool call ids of the examples, so they are the same on every run
+EXAMPLES_NAMESPACE = uuid.UUID("5b0f6c1e-8c5d-4a59-9a3e-2f1f5a7d9c10")
+
+
+def tool_example_to_messages(
+    example: Example, example_id: str = None
+) -> List[BaseMessage]:
     """Convert an example into a list of messages that can be fed into an LLM.
 
     This code is an adapter that converts our example to a list of messages
@@ -28,13 +68,21 @@ def tool_example_to_messages(example: Example) -> List[BaseMessage]:
 
     The ToolMessage is required because some of the chat models are hyper-optimized for agents
     rather than for an extraction use case.
+
+    When `example_id` is given the tool call ids are derived from it instead of being
+    random, so the same example always renders to the same messages.
     """
     messages: List[BaseMessage] = [HumanMessage(content=example["input"])]
     openai_tool_calls = []
-    for tool_call in example["tool_calls"]:
+    for idx, tool_call in enumerate(example["tool_calls"]):
+        if example_id is None:
+            tool_call_id = str(uuid.uuid4())
+        else:
+            tool_call_id = str(uuid.uuid5(EXAMPLES_NAMESPACE, f"{example_id}-{idx}"))
+
         openai_tool_calls.append(
             {
-                "id": str(uuid.uuid4()),
+                "id": tool_call_id,
                 "type": "function",
                 "function": {
                     "name": tool_call.__class__.__name__,
@@ -56,38 +104,508 @@ def tool_example_to_messages(example: Example) -> List[BaseMessage]:
     return messages
 
 
-def run_model_w_examples(text_prompt, example_data):
-    """Run the model with examples and text."""
+def example_to_messages(idx, text, candidate) -> List[BaseMessage]:
+    """Convert the `idx`-th `(text, Candidate)` example to prompt messages"""
+    return tool_example_to_messages(
+        {"input": text, "tool_calls": [candidate]}, example_id=str(idx)
+    )
+
+
+def packed_example_to_messages(idx, text, candidate) -> List[BaseMessage]:
+    """Convert the `idx`-th `(text, Candidate)` example to packed prompt messages"""
+    message_id = f"example-{idx}"
+    tool_call = PackedData(
+        people=[TaggedCandidate(**candidate.dict(), message_id=message_id)]
+    )
+    return tool_example_to_messages(
+        {"input": format_pack([(message_id, text)]), "tool_calls": [tool_call]},
+        example_id=f"packed-{idx}",
+    )
+
+
+def reduced_example_to_messages(idx, text, candidate) -> List[BaseMessage]:
+    """Convert the `idx`-th `(text, Candidate)` example to reduced prompt messages"""
+    tool_call = ReducedData(
+        people=[ReducedCandidate(**candidate.dict(exclude=set(RULE_FIELDS)))]
+    )
+    return tool_example_to_messages(
+        {"input": text, "tool_calls": [tool_call]}, example_id=f"reduced-{idx}"
+    )
+
+
+def examples_to_messages(examples) -> List[BaseMessage]:
+    """Convert a list of `(text, Candidate)` examples to prompt messages"""
+    messages = []
+    for idx, (text, candidate) in enumerate(examples):
+        messages.extend(example_to_messages(idx, text, candidate))
+    return messages
+
+
+def packed_examples_to_messages(examples) -> List[BaseMessage]:
+    """Convert a list of `(text, Candidate)` examples to packed prompt messages"""
+    messages = []
+    for idx, (text, candidate) in enumerate(examples):
+        messages.extend(packed_example_to_messages(idx, text, candidate))
+    return messages
+
+
+def reduced_examples_to_messages(examples) -> List[BaseMessage]:
+    """Convert a list of `(text, Candidate)` examples to reduced prompt messages"""
+    messages = []
+    for idx, (text, candidate) in enumerate(examples):
+        messages.extend(reduced_example_to_messages(idx, text, candidate))
+    return messages
+
+
+def format_pack(items):
+    """Join `(message_id, text)` items in a single prompt, tagging each email"""
+    return "\n\n".join(
+        f'<email id="{message_id}">\n{text}\n</email>' for message_id, text in items
+    )
+
+
+def pack_messages(items, token_budget=3000, max_per_pack=10):
+    """Group `(message_id, text)` items in packs that fit a token budget
+
+    Tokens are estimated as four characters per token. An item larger than the
+    budget gets a pack of its own, and an id is never repeated inside a pack.
+
+    Args:
+        items (list): The `(message_id, text)` items
+        token_budget (int): Maximum estimated tokens of the emails in a pack
+        max_per_pack (int): Maximum number of emails in a pack
+
+    Returns:
+        list: The packs, each a list of `(message_id, text)` items
+    """
+    packs = []
+    pack, pack_tokens = [], 0
+    for message_id, text in items:
+        tokens = len(text or "") // 4 + 20
+        full = pack_tokens + tokens > token_budget or len(pack) >= max_per_pack
+        repeated = any(message_id == pack_id for pack_id, _ in pack)
+        if pack and (full or repeated):
+            packs.append(pack)
+            pack, pack_tokens = [], 0
+
+        pack.append((message_id, text))
+        pack_tokens += tokens
+
+    if pack:
+        packs.append(pack)
+
+    return packs
+
+
+class LLMMetricsCallback(BaseCallbackHandler):
+    """Record the latency and token usage of every LLM call in the metrics"""
+
+    def __init__(self):
+        self._starts = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._starts[run_id] = time.perf_counter()
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._starts[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        start = self._starts.pop(run_id, None)
+        if start is not None:
+            metrics.observe("llm.latency", time.perf_counter() - start, kind="timing")
+        metrics.increment("llm.calls")
+
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        for name in ("prompt_tokens", "completion_tokens"):
+            if token_usage.get(name) is not None:
+                metrics.observe(f"llm.{name}", token_usage[name])
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._starts.pop(run_id, None)
+        metrics.increment("llm.errors")
+
+
+class Extractor:
+    """Extraction chain built once and reused across messages
+
+    Loading the examples, building the prompt and creating the `ChatOpenAI` client
+    (and its HTTP connection pool) happen once per process. The chain is only rebuilt
+    when the examples file changes on disk. The examples keep stable tool call ids,
+    so the prompt prefix is identical between calls and the provider prompt cache
+    can be used.
+
+    With `top_k` set, only the `top_k` examples most similar to each email (and
+    within `example_token_budget`) are added to its prompt, picked from a TF-IDF
+    index of the examples. This keeps the prompt size constant as the examples
+    file grows, at the cost of a prompt prefix that changes between emails.
+
+    Emails whose name and email were already found by the rule pass can be sent
+    with a reduced schema, without those fields, so the model writes less.
+    """
+
+    def __init__(
+        self,
+        examples_path,
+        model="gpt-3.5-turbo-0125",
+        temperature=0,
+        top_k=None,
+        example_token_budget=None,
+        llm=None,
+    ):
+        self.examples_path = examples_path
+        self.model = model
+        self.temperature = temperature
+        self.top_k = top_k
+        self.example_token_budget = example_token_budget
+        self._index = None
+        self._example_messages = []
+        self._packed_example_messages = []
+        self._reduced_example_messages = []
+        self._example_tokens = []
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._runnable = None
+        self._packed_runnable = None
+        self._reduced_runnable = None
+        self._llm = llm
+        self._examples_digest = None
+
+    def _build(self):
+        """Load the examples and build the single, packed and reduced chains"""
+        with open(self.examples_path, "rb") as f:
+            self._examples_digest = hashlib.sha256(f.read()).hexdigest()
+
+        examples = load_examples(self.examples_path)
+        self._example_messages = [
+            example_to_messages(idx, text, candidate)
+            for idx, (text, candidate) in enumerate(examples)
+        ]
+        self._packed_example_messages = [
+            packed_example_to_messages(idx, text, candidate)
+            for idx, (text, candidate) in enumerate(examples)
+        ]
+        self._reduced_example_messages = [
+            reduced_example_to_messages(idx, text, candidate)
+            for idx, (text, candidate) in enumerate(examples)
+        ]
+
+        if self.top_k is not None:
+            self._index = ExampleIndex.load_or_build(
+                self.examples_path, [text for text, _ in examples]
+            )
+            self._example_tokens = [
+                (len(text) + len(candidate.json())) // 4 for text, candidate in examples
+            ]
+
+        # Create LLM object once, the examples don't change the client
+        if self._llm is None:
+            self._llm = ChatOpenAI(
+                model=self.model,
+                temperature=self.temperature,  # because probably is better for extraction
+                callbacks=[LLMMetricsCallback()],
+            )
+
+        # Add all the examples to the prompt unless they are picked per email
+        prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", SYSTEM_PROMPT),
+                MessagesPlaceholder("examples"),
+                ("human", "{text}"),
+            ]
+        )
+        if self.top_k is None:
+            prompt = prompt.partial(examples=examples_to_messages(examples))
+
+        self._runnable = prompt | self._llm.with_structured_output(
+            schema=Data,
+            method="function_calling",
+            include_raw=False,
+        )
+
+        packed_prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", f"{SYSTEM_PROMPT} {PACKED_PROMPT}"),
+                MessagesPlaceholder("examples"),
+                ("human", "{text}"),
+            ]
+        )
+        if self.top_k is None:
+            packed_prompt = packed_prompt.partial(
+                examples=packed_examples_to_messages(examples)
+            )
+
+        self._packed_runnable = packed_prompt | self._llm.with_structured_output(
+            schema=PackedData,
+            method="function_calling",
+            include_raw=False,
+        )
+
+        reduced_prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", f"{SYSTEM_PROMPT} {REDUCED_PROMPT}"),
+                MessagesPlaceholder("examples"),
+                ("human", "{text}"),
+            ]
+        )
+        if self.top_k is None:
+            reduced_prompt = reduced_prompt.partial(
+                examples=reduced_examples_to_messages(examples)
+            )
+
+        self._reduced_runnable = reduced_prompt | self._llm.with_structured_output(
+            schema=ReducedData,
+            method="function_calling",
+            include_raw=False,
+        )
+
+    def _refresh(self):
+        """Build the chains again if the examples file changed"""
+        mtime = os.stat(self.examples_path).st_mtime
+        with self._lock:
+            if self._runnable is None or mtime != self._mtime:
+                self._build()
+                self._mtime = mtime
+
+    @property
+    def runnable(self):
+        """The extraction chain, rebuilt if the examples file changed"""
+        self._refresh()
+        return self._runnable
+
+    @property
+    def packed_runnable(self):
+        """The packed extraction chain, rebuilt if the examples file changed"""
+        self._refresh()
+        return self._packed_runnable
+
+    @property
+    def reduced_runnable(self):
+        """The reduced extraction chain, rebuilt if the examples file changed"""
+        self._refresh()
+        return self._reduced_runnable
+
+    @property
+    def fingerprint(self):
+        """Identify the model, schema and examples producing the extractions"""
+        # Accessing the runnable makes sure the digest matches the file on disk
+        self.runnable
+        fingerprint = f"{self.model}|{SCHEMA_VERSION}|{self._examples_digest}"
+        if self.top_k is not None:
+            fingerprint += f"|top{self.top_k}|{self.example_token_budget}"
+        return fingerprint
+
+    def _inputs(self, text, packed=False, reduced=False):
+        """Chain inputs of a text, with the examples picked for it if needed"""
+        if self.top_k is None:
+            return {"text": text}
+
+        selected = self._index.select(
+            text,
+            self.top_k,
+            token_budget=self.example_token_budget,
+            token_counts=self._example_tokens,
+        )
+        if packed:
+            example_messages = self._packed_example_messages
+        elif reduced:
+            example_messages = self._reduced_example_messages
+        else:
+            example_messages = self._example_messages
+
+        return {
+            "text": text,
+            "examples": [
+                message for idx in selected for message in example_messages[idx]
+            ],
+        }
+
+    def invoke(self, text_prompt):
+        """Extract the candidate data from a text"""
+        runnable = self.runnable
+        return runnable.invoke(self._inputs(text_prompt))
+
+    def batch(self, texts, max_concurrency=4, max_retries=5, backoff=1.0):
+        """Extract the candidate data from several texts concurrently
+
+        Texts are sent with at most `max_concurrency` requests in flight. When the
+        provider answers with a rate limit error (429) the rate-limited texts are
+        retried after an exponential backoff and with half the concurrency, so the
+        batch adapts to the available quota.
+
+        Args:
+            texts (list): The texts to extract data from
+            max_concurrency (int): Maximum number of requests in flight
+            max_retries (int): Maximum number of retries of rate-limited texts
+            backoff (float): Seconds to wait before the first retry
+
+        Returns:
+            list: A `Data` object or the raised exception for each text, in order
+        """
+        runnable = self.runnable
+        return self._batch(
+            runnable,
+            [self._inputs(text) for text in texts],
+            max_concurrency=max_concurrency,
+            max_retries=max_retries,
+            backoff=backoff,
+        )
+
+    def batch_reduced(self, texts, max_concurrency=4, max_retries=5, backoff=1.0):
+        """Extract the candidate data other than the rule fields from several texts
+
+        Same as `batch` with the reduced schema: the name and email of the returned
+        candidates are empty, for the caller to fill with the values of the rules.
+
+        Returns:
+            list: A `Data` object or the raised exception for each text, in order
+        """
+        runnable = self.reduced_runnable
+        outputs = self._batch(
+            runnable,
+            [self._inputs(text, reduced=True) for text in texts],
+            max_concurrency=max_concurrency,
+            max_retries=max_retries,
+            backoff=backoff,
+        )
+        return [
+            output.to_data() if isinstance(output, ReducedData) else output
+            for output in outputs
+        ]
+
+    def batch_packed(self, packs, max_concurrency=4, max_retries=5, backoff=1.0):
+        """Extract the candidate data of packs of emails concurrently
+
+        Each pack is sent as a single request with every email tagged with its id,
+        and the returned candidates are mapped back to their emails. An email is
+        only mapped when exactly one candidate carries its id; if the model returns
+        a candidate with an unknown id the whole pack is treated as ambiguous.
+
+        Args:
+            packs (list): Packs of `(message_id, text)` items, see `pack_messages`
+            max_concurrency (int): Maximum number of requests in flight
+            max_retries (int): Maximum number of retries of rate-limited packs
+            backoff (float): Seconds to wait before the first retry
+
+        Returns:
+            list: For each pack, a dict with a `Data` object keyed by message id.
+            Emails that could not be mapped unambiguously are left out, so the
+            caller can extract them one by one.
+        """
+        runnable = self.packed_runnable
+        outputs = self._batch(
+            runnable,
+            [self._inputs(format_pack(pack), packed=True) for pack in packs],
+            max_concurrency=max_concurrency,
+            max_retries=max_retries,
+            backoff=backoff,
+        )
+
+        results = []
+        for pack, output in zip(packs, outputs):
+            if isinstance(output, Exception) or output is None:
+                results.append({})
+            else:
+                message_ids = [message_id for message_id, _ in pack]
+                results.append(output.split_by_message(message_ids))
+
+        return results
+
+    def _batch(self, runnable, inputs, max_concurrency, max_retries, backoff):
+        """Invoke a chain on several inputs with adaptive backoff on 429s"""
+        results = [None] * len(inputs)
+        pending = list(range(len(inputs)))
+        concurrency = max_concurrency
+        delay = backoff
+
+        for attempt in range(max_retries + 1):
+            outputs = runnable.batch(
+                [inputs[idx] for idx in pending],
+                config={"max_concurrency": concurrency},
+                return_exceptions=True,
+            )
+
+            rate_limited = []
+            for idx, output in zip(pending, outputs):
+                if is_rate_limit_error(output) and attempt < max_retries:
+                    rate_limited.append(idx)
+                else:
+                    results[idx] = output
+
+            if not rate_limited:
+                break
+
+            metrics.increment("llm.retries", len(rate_limited))
+
+            # Back off and slow down before retrying the rate-limited texts
+            time.sleep(delay)
+            delay *= 2
+            concurrency = max(1, concurrency // 2)
+            pending = rate_limited
+
+        return results
+
+
+def is_rate_limit_error(error):
+    """Check if an exception is a rate limit (429) error of the provider"""
+    if not isinstance(error, Exception):
+        return False
+    return (
+        getattr(error, "status_code", None) == 429
+        or error.__class__.__name__ == "RateLimitError"
+    )
+
+
+_extractors = {}
+_extractors_lock = threading.Lock()
+
+
+def get_extractor(examples_path, **options):
+    """Get the process-wide extractor of an examples file
+
+    Args:
+        examples_path (str): Path to the examples file
+        **options: Other arguments of `Extractor`, e.g. `top_k`
+
+    Returns:
+        Extractor: The extractor, created on the first call
+    """
+    options = {name: value for name, value in options.items() if value is not None}
+    key = (examples_path, tuple(sorted(options.items())))
+    with _extractors_lock:
+        if key not in _extractors:
+            _extractors[key] = Extractor(examples_path, **options)
+        return _extractors[key]
+
+
+def run_model_w_examples(text_prompt, example_data, cache=None):
+    """Run the model with examples and text.
+
+    When `example_data` is the path to the examples file the process-wide extractor
+    of that file is reused, and if an `ExtractionCache` is given it is checked
+    before calling the model. A list of examples builds a one-off chain.
+    """
+
+    # Load examples for in-context inference
+    if isinstance(example_data, str):
+        extractor = get_extractor(example_data)
+        if cache is None:
+            return extractor.invoke(text_prompt)
+
+        data = cache.get(text_prompt, extractor.fingerprint)
+        if data is None:
+            data = extractor.invoke(text_prompt)
+            cache.put(text_prompt, extractor.fingerprint, data)
+        return data
 
     # Create a chat prompt
     prompt = ChatPromptTemplate.from_messages(
         [
-            (
-                "system",
-                "You are an expert email extraction algorithm and an HR manager "
-                "You watn to pick the best candidates for a new position."
-                "Only extract relevant information from the text. "
-                "If you do not know the value of an attribute asked "
-                "to extract, return null for the attribute's value.",
-            ),
+            ("system", SYSTEM_PROMPT),
             MessagesPlaceholder("examples"),
             ("human", "{text}"),
         ]
     )
 
-    # Load examples for in-context inference
-    if isinstance(example_data, str):
-        examples = load_examples(example_data)
-    else:
-        examples = example_data
-
-    # Add the examples to the prompt
-    messages = []
-    for text, tool_call in examples:
-        messages.extend(
-            tool_example_to_messages({"input": text, "tool_calls": [tool_call]})
-        )
-
     # Create LLM object
     llm = ChatOpenAI(
         model="gpt-3.5-turbo-0125",
@@ -103,6 +621,6 @@ def run_model_w_examples(text_prompt, example_data):
     return runnable.invoke(
         {
             "text": text_prompt,
-            "examples": messages,
+            "examples": examples_to_messages(example_data),
         }
     )
@@ -0,0 +1,151 @@
+import time
+
+
+def create_failures_table(conn):
+    """Create the ledger of the messages whose extraction failed"""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS extraction_failures
+        (channel_id TEXT, ts TEXT, error_class TEXT, error TEXT, attempts INT,
+        first_failed_at REAL, last_failed_at REAL, next_attempt_at REAL,
+        PRIMARY KEY (channel_id, ts))
+        """
+    )
+    conn.commit()
+
+
+class FailureLedger:
+    """Dead-letter ledger of the messages whose extraction failed
+
+    Every failure of a message is recorded with its error and the message is not
+    selected for extraction again until `next_attempt_at`, which backs off
+    exponentially from `base_delay` seconds up to `max_delay`. After
+    `max_attempts` failures the message is dead: it is never retried unless it is
+    requeued, so broken messages stop costing LLM calls on every reload.
+    """
+
+    def __init__(self, conn, max_attempts=5, base_delay=3600, max_delay=7 * 86400):
+        self.conn = conn
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        create_failures_table(conn)
+
+    def record(self, failures):
+        """Record failed extractions
+
+        Args:
+            failures (list): `(channel_id, ts, exception)` of each failed message
+        """
+        now = time.time()
+        for channel_id, ts, error in failures:
+            row = self.conn.execute(
+                "SELECT attempts FROM extraction_failures WHERE channel_id = ? AND ts = ?",
+                (channel_id, ts),
+            ).fetchone()
+            attempts = (row[0] if row else 0) + 1
+
+            if attempts >= self.max_attempts:
+                next_attempt_at = None
+            else:
+                delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+                next_attempt_at = now + delay
+
+            self.conn.execute(
+                """
+                INSERT INTO extraction_failures
+                (channel_id, ts, error_class, error, attempts, first_failed_at,
+                last_failed_at, next_attempt_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(channel_id, ts) DO UPDATE SET
+                    error_class = excluded.error_class,
+                    error = excluded.error,
+                    attempts = excluded.attempts,
+                    last_failed_at = excluded.last_failed_at,
+                    next_attempt_at = excluded.next_attempt_at
+                """,
+                (
+                    channel_id,
+                    ts,
+                    error.__class__.__name__,
+                    str(error)[:500],
+                    attempts,
+                    now,
+                    now,
+                    next_attempt_at,
+                ),
+            )
+
+        self.conn.commit()
+
+    def resolve(self, keys):
+        """Forget the failures of messages that were extracted
+
+        Args:
+            keys (list): `(channel_id, ts)` of the extracted messages
+        """
+        self.conn.executemany(
+            "DELETE FROM extraction_failures WHERE channel_id = ? AND ts = ?", keys
+        )
+        self.conn.commit()
+
+    def requeue(self, ts=None):
+        """Make failed messages eligible for extraction again
+
+        Args:
+            ts (str): Slack `ts` of the message to requeue, all of them when None
+
+        Returns:
+            int: Number of messages requeued
+        """
+        if ts is None:
+            cursor = self.conn.execute("DELETE FROM extraction_failures")
+        else:
+            cursor = self.conn.execute(
+                "DELETE FROM extraction_failures WHERE ts = ?", (ts,)
+            )
+        self.conn.commit()
+        return cursor.rowcount
+
+    def entries(self, limit=20):
+        """Get the latest failures
+
+        Args:
+            limit (int): Maximum number of failures returned
+
+        Returns:
+            list: A dict per failure, newest first, with `next_attempt_at` None
+                for the dead messages
+        """
+        rows = self.conn.execute(
+            """
+            SELECT channel_id, ts, error_class, error, attempts, last_failed_at,
+                next_attempt_at
+            FROM extraction_failures
+            ORDER BY last_failed_at DESC
+            LIMIT ?
+            """,
+            (limit,),
+        ).fetchall()
+
+        columns = [
+            "channel_id",
+            "ts",
+            "error_class",
+            "error",
+            "attempts",
+            "last_failed_at",
+            "next_attempt_at",
+        ]
+        return [dict(zip(columns, row)) for row in rows]
+
+    def stats(self):
+        """Count the messages waiting for a retry and the dead ones"""
+        waiting, dead = self.conn.execute(
+            """
+            SELECT COUNT(next_attempt_at), COUNT(*) - COUNT(next_attempt_at)
+            FROM extraction_failures
+            """
+        ).fetchone()
+        return {"waiting": waiting, "dead": dead}
@@ -0,0 +1,130 @@
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Job:
+    """A background run of the bot pipeline
+
+    The job keeps its state (`queued`, `running`, `done` or `failed`), the stage
+    it is working on and the listeners notified on every change, e.g. the Slack
+    messages showing its progress.
+    """
+
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex[:8]
+        self.name = name
+        self.state = "queued"
+        self.stage = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.rerun_requested = False
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        """Whether the job is still queued or running"""
+        return self.state in ("queued", "running")
+
+    def add_listener(self, listener):
+        """Call `listener(job)` on every change, starting with the current state"""
+        with self._lock:
+            self._listeners.append(listener)
+        self._notify(listener)
+
+    def report(self, stage):
+        """Set the stage the job is working on and notify the listeners"""
+        self.stage = stage
+        for listener in list(self._listeners):
+            self._notify(listener)
+
+    def _notify(self, listener):
+        try:
+            listener(self)
+        except Exception as e:
+            print(f"Error notifying job {self.id}: {e}")
+
+    def describe(self):
+        """Short human readable description of the job"""
+        end = self.finished_at or time.time()
+        elapsed = end - (self.started_at or self.created_at)
+        text = f"{self.name} job `{self.id}` {self.state}"
+        if self.stage:
+            text += f" ({self.stage})"
+        text += f" after {elapsed:.0f}s"
+        if self.error:
+            text += f": {self.error}"
+        return text
+
+
+class JobRunner:
+    """Run jobs in background threads, at most one run of each job name at a time
+
+    Submitting a job while another one with the same name is queued or running
+    doesn't start a new run: the caller gets the job in flight instead, so
+    concurrent requests are coalesced into a single run. Submitting with `rerun`
+    asks a running job to run once more when it finishes, for work that arrived
+    after the run started.
+    """
+
+    def __init__(self, max_workers=2):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="job"
+        )
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def submit(self, name, func, rerun=False):
+        """Run `func(job)` in the background unless a job `name` is in flight
+
+        Args:
+            name (str): Name of the job, runs with the same name are coalesced
+            func (callable): The work to run, called with the `Job`
+            rerun (bool): If the job in flight is already running, run it again
+                once it finishes
+
+        Returns:
+            tuple: The `Job` and whether a new run was started
+        """
+        with self._lock:
+            job = self._jobs.get(name)
+            if job is not None and job.active:
+                if rerun and job.state == "running":
+                    job.rerun_requested = True
+                return job, False
+
+            job = Job(name)
+            self._jobs[name] = job
+
+        self._executor.submit(self._run, job, func)
+        return job, True
+
+    def _run(self, job, func):
+        job.state = "running"
+        job.started_at = time.time()
+        try:
+            while True:
+                func(job)
+                with self._lock:
+                    if not job.rerun_requested:
+                        job.state = "done"
+                        break
+                    job.rerun_requested = False
+        except Exception as e:
+            traceback.print_exc()
+            with self._lock:
+                job.state = "failed"
+                job.error = f"{e.__class__.__name__}: {e}"
+        finally:
+            job.finished_at = time.time()
+            job.report(job.stage)
+
+    def status(self, name):
+        """Get the latest job submitted with a name, None if there is none"""
+        with self._lock:
+            return self._jobs.get(name)
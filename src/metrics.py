@@ -0,0 +1,131 @@
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+
+def create_metrics_table(conn):
+    """Create the table keeping the pipeline metrics"""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS metrics
+        (name TEXT, kind TEXT, value REAL, recorded_at REAL)
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_metrics_recorded_at ON metrics (recorded_at)"
+    )
+    conn.commit()
+
+
+class Metrics:
+    """Collect the timings, token usage and API call counters of the pipeline
+
+    Samples are kept in memory, which is safe to do from any thread, and written
+    to the `metrics` table by `flush` at the end of each run.
+
+    Kinds of samples:
+        timing: seconds spent in a stage or call
+        value: a quantity, e.g. tokens of a prompt
+        counter: a number of events, e.g. Slack calls
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = []
+
+    def observe(self, name, value, kind="value"):
+        """Record a sample"""
+        with self._lock:
+            self._samples.append((name, kind, float(value), time.time()))
+
+    def increment(self, name, value=1):
+        """Record `value` more events of a counter"""
+        self.observe(name, value, kind="counter")
+
+    @contextmanager
+    def timer(self, name):
+        """Record the seconds spent in a block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, kind="timing")
+
+    def timed(self, name):
+        """Decorator recording the seconds spent in each call of a function"""
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def flush(self, conn):
+        """Write the samples to the `metrics` table and forget them
+
+        Returns:
+            int: Number of samples written
+        """
+        with self._lock:
+            samples, self._samples = self._samples, []
+
+        create_metrics_table(conn)
+        conn.executemany(
+            "INSERT INTO metrics (name, kind, value, recorded_at) VALUES (?, ?, ?, ?)",
+            samples,
+        )
+        conn.commit()
+        return len(samples)
+
+
+def _percentile(values, q):
+    """Nearest-rank percentile of sorted values"""
+    idx = min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))
+    return values[idx]
+
+
+def summarize_metrics(conn, days=7):
+    """Summarize the metrics recorded in the last days
+
+    Args:
+        conn (sqlite3.Connection): The SQLite connection
+        days (int): Number of days to summarize
+
+    Returns:
+        list: A dict per metric with its kind, count, total, p50, p95 and max
+    """
+    create_metrics_table(conn)
+    rows = conn.execute(
+        """
+        SELECT name, kind, value FROM metrics
+        WHERE recorded_at >= ?
+        ORDER BY name, value
+        """,
+        (time.time() - days * 24 * 3600,),
+    ).fetchall()
+
+    grouped = {}
+    for name, kind, value in rows:
+        grouped.setdefault((name, kind), []).append(value)
+
+    return [
+        {
+            "name": name,
+            "kind": kind,
+            "count": len(values),
+            "total": sum(values),
+            "p50": _percentile(values, 50),
+            "p95": _percentile(values, 95),
+            "max": values[-1],
+        }
+        for (name, kind), values in grouped.items()
+    ]
+
+
+# Metrics of the running process
+metrics = Metrics()
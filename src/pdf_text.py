@@ -0,0 +1,137 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # PDF text is optional, messages are parsed without it
+    PdfReader = None
+
+from .downloader import create_downloads_table
+
+
+def create_pdf_text_table(conn):
+    """Create the cache of the text extracted from the downloaded PDFs"""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS pdf_text
+        (file_id TEXT PRIMARY KEY, text TEXT, error TEXT, extracted_at REAL)
+        """
+    )
+    conn.commit()
+
+
+def read_pdf_text(path, max_pages=5):
+    """Extract the text of the first pages of a PDF
+
+    Args:
+        path (str): Path to the PDF
+        max_pages (int): Maximum number of pages read
+
+    Returns:
+        tuple: The text and None, or None and the error message
+    """
+    try:
+        reader = PdfReader(path)
+        pages = [page.extract_text() or "" for page in reader.pages[:max_pages]]
+        return " ".join(" ".join(pages).split()), None
+    except Exception as e:
+        return None, f"{e.__class__.__name__}: {e}"
+
+
+def extract_pdf_texts(conn, max_workers=2, max_pages=5):
+    """Extract the text of the downloaded PDFs that were not processed yet
+
+    PDFs are parsed in a process pool and the result is cached by Slack file ID in
+    the `pdf_text` table, errors included, so a PDF is never parsed twice. Workers
+    are spawned rather than forked, the bot calls this with other threads running
+    and a forked child could inherit a lock held by one of them.
+
+    Args:
+        conn (sqlite3.Connection): The SQLite connection
+        max_workers (int): Maximum number of processes parsing PDFs
+        max_pages (int): Maximum number of pages read per PDF
+
+    Returns:
+        int: Number of PDFs processed
+    """
+    if PdfReader is None:
+        print("pypdf is not installed, skipping the PDF attachments")
+        return 0
+
+    create_downloads_table(conn)
+    create_pdf_text_table(conn)
+    pending = conn.execute(
+        """
+        SELECT d.file_id, d.path
+        FROM downloads d
+        LEFT JOIN pdf_text p ON p.file_id = d.file_id
+        WHERE p.file_id IS NULL AND d.path LIKE '%.pdf'
+        """
+    ).fetchall()
+
+    if not pending:
+        return 0
+
+    file_ids = [file_id for file_id, _ in pending]
+    paths = [path for _, path in pending]
+    with ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        results = list(executor.map(read_pdf_text, paths, [max_pages] * len(paths)))
+
+    conn.executemany(
+        "INSERT OR REPLACE INTO pdf_text (file_id, text, error, extracted_at) VALUES (?, ?, ?, ?)",
+        [
+            (file_id, text, error, time.time())
+            for file_id, (text, error) in zip(file_ids, results)
+        ],
+    )
+    conn.commit()
+
+    return len(pending)
+
+
+def attachment_excerpts(conn, keys, token_budget=1000):
+    """Get an excerpt of the text of the PDFs attached to some messages
+
+    The text of all the PDFs of a message is joined and cut to `token_budget`
+    tokens, estimated as four characters per token.
+
+    Args:
+        conn (sqlite3.Connection): The SQLite connection
+        keys (list): `(channel_id, ts)` of the messages
+        token_budget (int): Maximum estimated tokens of each excerpt
+
+    Returns:
+        dict: The excerpt of the messages with PDF text, keyed by `(channel_id, ts)`
+    """
+    if not keys:
+        return {}
+
+    create_downloads_table(conn)
+    create_pdf_text_table(conn)
+
+    # Messages saved by older versions have the `ts` rounded to the second, their
+    # files are the ones posted within that second
+    rows = conn.execute(
+        f"""
+        WITH batch (channel_id, ts) AS (VALUES {", ".join("(?, ?)" for _ in keys)})
+        SELECT b.channel_id, b.ts, p.text
+        FROM batch b
+        JOIN downloads d ON d.channel_id = b.channel_id
+            AND d.message_ts BETWEEN b.ts
+                AND b.ts || CASE WHEN instr(b.ts, '.') = 0 THEN '.999999' ELSE '' END
+        JOIN pdf_text p ON p.file_id = d.file_id
+        WHERE p.text IS NOT NULL AND p.text != ''
+        ORDER BY d.file_id
+        """,
+        [value for key in keys for value in key],
+    ).fetchall()
+
+    texts = {}
+    for channel_id, ts, text in rows:
+        texts.setdefault((channel_id, ts), []).append(text)
+
+    max_chars = token_budget * 4
+    return {key: " ".join(parts)[:max_chars] for key, parts in texts.items()}
@@ -1,14 +1,306 @@
-import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import pandas as pd
-import requests
 from slack_sdk.errors import SlackApiError
 from tqdm import tqdm
 
-from .extractor import run_model_w_examples
-from .database_manager import structure_messages
+from .cache import ExtractionCache
+from .classifier import MessageClassifier
+from .dedup import CandidateDeduplicator
+from .downloader import AttachmentDownloader
+from .failures import FailureLedger
+from .extractor import get_extractor, pack_messages
+from .metrics import metrics
+from .pdf_text import attachment_excerpts, extract_pdf_texts
+from .rules import extract_rule_fields
+from .schemas import FALLBACK_RULE_FIELDS, RULE_FIELDS, Data
+from .scheduler import SlackScheduler
+from .database_manager import (
+    changed_threads,
+    get_sync_state,
+    insert_parsed_messages,
+    project_message,
+    select_unparsed_messages,
+    update_sync_state,
+    update_thread_state,
+    update_threads_checked,
+    upsert_messages,
+)
 
 
+def _latest_ts(current, candidate):
+    """Return the newest of two Slack timestamps, ignoring missing values"""
+    if current is None:
+        return candidate
+    if candidate is None:
+        return current
+    return candidate if float(candidate) > float(current) else current
+
+
+def _filter_messages(messages, filter_users=None):
+    """Keep messages from the given users and drop channel events"""
+    if filter_users:
+        messages = [
+            message
+            for message in messages
+            if message.get("user") in filter_users and "inviter" not in message.keys()
+        ]
+
+    # Remove messages that are channel events
+    return [message for message in messages if "subtype" not in message.keys()]
+
+
+def _attach_files(messages, channel_id):
+    """Add the file URLs as `file_n` keys and return the PDFs attached"""
+    pdf_files = []
+    for message in messages:
+        # We have files as dict format in a list
+        if "files" in message.keys():
+            for idx, file in enumerate(message["files"]):
+                message[f"file_{idx + 1}"] = file["url_private"]
+
+                if file.get("filetype") == "pdf":
+                    pdf_files.append(
+                        {**file, "message_ts": message["ts"], "channel_id": channel_id}
+                    )
+
+    return pdf_files
+
+
+def iter_history_pages(
+    client,
+    channel_id,
+    oldest="0",
+    cursor=None,
+    page_size=200,
+    scheduler=None,
+    latest=None,
+):
+    """Iterate over the pages of the history of a Slack channel
+
+    Pages are requested one at a time as the caller consumes them, so only one
+    page of messages is held in memory whatever the size of the history.
+
+    Args:
+        client (slack_sdk.WebClient): The Slack client
+        channel_id (str): The ID of the channel
+        oldest (str): Only messages newer than this Slack `ts` are requested
+        cursor (str): Cursor of the page to start from
+        page_size (int): Number of messages requested per page
+        scheduler (SlackScheduler): Scheduler shared with other threads calling Slack
+        latest (str): Only messages older than this Slack `ts` are requested, all
+            of them if None
+
+    Yields:
+        tuple: The messages of a page and the cursor of the next page, None on the
+            last page
+    """
+    scheduler = scheduler or SlackScheduler()
+    bounds = {"oldest": oldest}
+    if latest is not None:
+        bounds["latest"] = latest
+    while True:
+        result = scheduler.call(
+            "conversations.history",
+            client.conversations_history,
+            channel=channel_id,
+            cursor=cursor,
+            limit=page_size,
+            **bounds,
+        )
+
+        cursor = (result.data.get("response_metadata") or {}).get("next_cursor")
+        if not result.data.get("has_more"):
+            cursor = None
+
+        yield result.data["messages"], cursor or None
+
+        if not cursor:
+            return
+
+
+def iter_thread_replies(
+    client, channel_id, thread_ts, oldest=None, page_size=200, scheduler=None
+):
+    """Iterate over the pages of replies of a Slack thread
+
+    Args:
+        client (slack_sdk.WebClient): The Slack client
+        channel_id (str): The ID of the channel
+        thread_ts (str): The `ts` of the parent message of the thread
+        oldest (str): Only replies newer than this Slack `ts` are requested
+        page_size (int): Number of messages requested per page
+        scheduler (SlackScheduler): Scheduler shared with other threads calling Slack
+
+    Yields:
+        list: The replies of a page, without the parent message
+    """
+    scheduler = scheduler or SlackScheduler()
+    cursor = None
+    while True:
+        result = scheduler.call(
+            "conversations.replies",
+            client.conversations_replies,
+            channel=channel_id,
+            ts=thread_ts,
+            oldest=oldest or "0",
+            cursor=cursor,
+            limit=page_size,
+        )
+
+        # Slack returns the parent message at the top of the replies
+        yield [
+            message for message in result.data["messages"] if message["ts"] != thread_ts
+        ]
+
+        cursor = (result.data.get("response_metadata") or {}).get("next_cursor")
+        if not cursor or not result.data.get("has_more"):
+            return
+
+
+def sync_threads(
+    client,
+    channel_id,
+    db_conn,
+    threads,
+    messages_table="messages",
+    filter_users=None,
+    page_size=200,
+    scheduler=None,
+    downloader=None,
+    max_workers=4,
+):
+    """Save the new replies of the threads whose latest reply moved
+
+    The `latest_reply` of each thread, as seen on its parent message in the
+    channel history, is compared with the one saved in the `thread_state` table
+    by the last sync, and only the threads with newer replies are requested, from
+    the last reply synced on. Threads are requested concurrently, and each reply is
+    saved with the `ts` of its parent message in `parent_ts`.
+
+    Args:
+        client (slack_sdk.WebClient): The Slack client
+        channel_id (str): The ID of the channel
+        db_conn (sqlite3.Connection): The SQLite connection
+        threads (dict): The `latest_reply` of each thread keyed by `thread_ts`
+        messages_table (str): Name of the table to save the messages
+        filter_users (list): A list of user IDs to filter replies by
+        page_size (int): Number of replies requested per page
+        scheduler (SlackScheduler): Scheduler shared with other threads calling Slack
+        downloader (AttachmentDownloader): Downloader of the PDFs attached to the
+            replies, they are not downloaded if None
+        max_workers (int): Maximum number of threads requested at the same time
+
+    Returns:
+        int: Number of replies saved
+    """
+    changed = changed_threads(db_conn, channel_id, threads)
+    if not changed:
+        return 0
+
+    def fetch(thread_ts):
+        pages = iter_thread_replies(
+            client,
+            channel_id,
+            thread_ts,
+            oldest=changed[thread_ts],
+            page_size=page_size,
+            scheduler=scheduler,
+        )
+        return [reply for page in pages for reply in page]
+
+    saved = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(fetch, thread_ts): thread_ts for thread_ts in changed
+        }
+        for future in as_completed(futures):
+            thread_ts = futures[future]
+            try:
+                replies = future.result()
+            except SlackApiError as e:
+                print(f"Error retrieving thread {thread_ts}: {e.response['error']}")
+                continue
+
+            # Slack returns the parent first, it is saved by the history sync
+            replies = [reply for reply in replies if reply["ts"] != thread_ts]
+            replies = _filter_messages(replies, filter_users)
+            pdf_files = _attach_files(replies, channel_id)
+            if downloader is not None and pdf_files:
+                downloader.download(pdf_files, db_conn)
+
+            additional_columns = {"channel_id": channel_id, "parent_ts": thread_ts}
+            upsert_messages(
+                db_conn,
+                [project_message(reply, additional_columns) for reply in replies],
+                table=messages_table,
+            )
+            update_thread_state(db_conn, channel_id, thread_ts, threads[thread_ts])
+            saved += len(replies)
+
+    return saved
+
+
+def recent_threads(
+    client,
+    channel_id,
+    db_conn,
+    oldest,
+    latest,
+    messages_table="messages",
+    filter_users=None,
+    page_size=200,
+    scheduler=None,
+):
+    """Get the `latest_reply` of the threads started in a window of the history
+
+    The history already synced between `oldest` and `latest` is requested again,
+    and the parent messages of threads are saved with their new reply count and
+    `latest_reply`. The other messages are not written again.
+
+    Args:
+        client (slack_sdk.WebClient): The Slack client
+        channel_id (str): The ID of the channel
+        db_conn (sqlite3.Connection): The SQLite connection
+        oldest (str): Only threads started after this Slack `ts` are returned
+        latest (str): Only threads started before this Slack `ts` are returned
+        messages_table (str): Name of the table to save the messages
+        filter_users (list): A list of user IDs to filter messages by
+        page_size (int): Number of messages requested per page
+        scheduler (SlackScheduler): Scheduler shared with other threads calling Slack
+
+    Returns:
+        dict: The `latest_reply` of each thread keyed by `thread_ts`
+    """
+    additional_columns = {"channel_id": channel_id}
+
+    threads = {}
+    pages = iter_history_pages(
+        client,
+        channel_id,
+        oldest=oldest,
+        latest=latest,
+        page_size=page_size,
+        scheduler=scheduler,
+    )
+    for page, _ in pages:
+        parents = [
+            message
+            for message in _filter_messages(page, filter_users)
+            if message.get("latest_reply")
+        ]
+        upsert_messages(
+            db_conn,
+            [project_message(parent, additional_columns) for parent in parents],
+            table=messages_table,
+        )
+        threads.update((parent["ts"], parent["latest_reply"]) for parent in parents)
+
+    return threads
+
+
+@metrics.timed("retrieve_messages")
 def retrieve_messages(
     client,
     channel_id,
@@ -17,116 +309,653 @@ def retrieve_messages(
     save_data="data",
     filter_users=None,
     download=False,
+    page_size=200,
+    scheduler=None,
+    downloader=None,
+    threads=True,
+    thread_lookback_days=30,
+    thread_check_hours=6,
 ):
     """Retrieve messages from a Slack channel and filter them by user
 
+    Only messages newer than the channel watermark saved in the `sync_state` table
+    are requested, and the history is paginated following
+    `response_metadata.next_cursor` until Slack has no more pages. Every page is
+    projected onto the columns of the messages table and written to the database as
+    it arrives, then the cursor is saved, so memory use doesn't grow with the
+    history and an interrupted sync resumes from the last page instead of starting
+    over. If Slack no longer accepts the saved cursor, it is dropped and the sync
+    starts again from the watermark.
+
+    With `threads` set, the new replies of the threads whose `latest_reply` moved
+    are saved by `sync_threads`. The threads of the new messages are checked on
+    every sync. The threads started in the `thread_lookback_days` before the
+    watermark are only checked once every `thread_check_hours`, by requesting that
+    window of the history again (`recent_threads`): the replies posted while the
+    bot is running arrive as message events, so this only catches the ones it
+    missed. Older threads are not checked again.
+
     Args:
         client (slack_sdk.WebClient): The Slack client
         channel_id (str): The ID of the channel to retrieve messages from
-        db_path (str): Path to the SQLite database
+        db_conn (sqlite3.Connection): The SQLite connection
         messages_table (str): Name of the table to save the messages
         filter_users (list): A list of user IDs to filter messages by
         save_data (str): The path to the folder to save the files
+        download (bool): Download the PDF files attached to the messages
+        page_size (int): Number of messages requested per page
+        scheduler (SlackScheduler): Scheduler shared with other threads calling Slack
+        downloader (AttachmentDownloader): Downloader shared with other threads,
+            created if `download` is set and none is given
+        threads (bool): Save the new replies of the threads
+        thread_lookback_days (float): Days before the watermark in which threads
+            are checked for new replies
+        thread_check_hours (float): Hours between two checks of the threads before
+            the watermark
 
     Returns:
-        list: A list of messages from the channel
+        int: Number of new messages and replies saved from the channel
     """
 
-    # Create folder if save_data doesn't exist
-    if not os.path.exists("data/downloads"):
-        os.makedirs("data/downloads")
+    if download and downloader is None:
+        downloader = AttachmentDownloader(save_data)
+
+    state = get_sync_state(db_conn, channel_id)
+    latest_ts = state["pending_latest_ts"] or state["latest_ts"]
 
-    # Check if filename exists (run only daily, best case scenario)
+    # Create dict with additional columns
+    additional_columns = {"channel_id": channel_id}
+
+    saved = 0
+    thread_replies = {}
     try:
-        # Retrieve messages from the channel
-        result = client.conversations_history(channel=channel_id)
-
-        # Filter messages by user
-        if filter_users:
-            messages = [
-                message
-                for message in result.data["messages"]
-                if message["user"] in filter_users and "inviter" not in message.keys()
-            ]
-        else:
-            messages = result.data["messages"]
+        # Retrieve messages newer than the watermark from the channel
+        pages = iter_history_pages(
+            client,
+            channel_id,
+            oldest=state["latest_ts"] or "0",
+            cursor=state["cursor"],
+            page_size=page_size,
+            scheduler=scheduler,
+        )
+        for page, cursor in pages:
+            for message in page:
+                latest_ts = _latest_ts(latest_ts, message["ts"])
 
-        # Remove messages that are channel events
-        messages = [message for message in messages if "subtype" not in message.keys()]
+            messages = _filter_messages(page, filter_users)
+            pdf_files = _attach_files(messages, channel_id)
+            if download and pdf_files:
+                downloader.download(pdf_files, db_conn)
 
-        # Download files if any of the messages has a file
-        for message in messages:
-            # We have files as dict format in a list
+            # Update database
+            upsert_messages(
+                db_conn,
+                [project_message(message, additional_columns) for message in messages],
+                table=messages_table,
+            )
+            saved += len(messages)
 
-            if "files" in message.keys():
-                for idx, file in enumerate(message["files"]):
-                    file_url = file["url_private"]
+            thread_replies.update(
+                (message["ts"], message["latest_reply"])
+                for message in messages
+                if message.get("latest_reply")
+            )
 
-                    message[f"file_{idx + 1}"] = file_url
+            if cursor:
+                # Save the cursor so an interrupted sync resumes from this page
+                update_sync_state(
+                    db_conn,
+                    channel_id,
+                    state["latest_ts"],
+                    cursor=cursor,
+                    pending_latest_ts=latest_ts,
+                )
 
-                    if download:
-                        if file["filetype"] == "pdf":
-                            file_path = os.path.join(save_data, file["id"])
+        # History is exhausted: move the watermark forward
+        update_sync_state(db_conn, channel_id, latest_ts)
 
-                            # Use the token for authentication
-                            token = os.getenv("SLACK_API_TOKEN")
-                            headers = {"Authorization": f"Bearer {token}"}
+        # Look back for threads started before the watermark, once in a while. A
+        # first sync has seen every thread already.
+        checked_at = state["threads_checked_at"]
+        if threads and not state["latest_ts"]:
+            update_threads_checked(db_conn, channel_id)
+        elif threads and (
+            checked_at is None or time.time() - checked_at >= thread_check_hours * 3600
+        ):
+            lookback = float(state["latest_ts"]) - thread_lookback_days * 86400
+            recent = recent_threads(
+                client,
+                channel_id,
+                db_conn,
+                oldest=f"{max(0, lookback):.6f}",
+                latest=state["latest_ts"],
+                messages_table=messages_table,
+                filter_users=filter_users,
+                page_size=page_size,
+                scheduler=scheduler,
+            )
+            thread_replies = {**recent, **thread_replies}
+            update_threads_checked(db_conn, channel_id)
 
-                            response = requests.get(file_url, headers=headers)
-                            with open(f"{file_path}.pdf", "wb") as f:
-                                f.write(response.content)
+        if threads and thread_replies:
+            saved += sync_threads(
+                client,
+                channel_id,
+                db_conn,
+                thread_replies,
+                messages_table=messages_table,
+                filter_users=filter_users,
+                page_size=page_size,
+                scheduler=scheduler,
+                downloader=downloader if download else None,
+            )
 
     except SlackApiError as e:
+        if state["cursor"] and e.response["error"] == "invalid_cursor":
+            # The saved cursor expired: drop it and sync again from the watermark
+            print(f"Cursor of {channel_id} is no longer valid, syncing again")
+            update_sync_state(db_conn, channel_id, state["latest_ts"])
+            return saved + retrieve_messages(
+                client,
+                channel_id,
+                db_conn,
+                messages_table,
+                save_data=save_data,
+                filter_users=filter_users,
+                download=download,
+                page_size=page_size,
+                scheduler=scheduler,
+                downloader=downloader,
+                threads=threads,
+                thread_lookback_days=thread_lookback_days,
+                thread_check_hours=thread_check_hours,
+            )
         print(f"Error: {e.response['error']}")
 
-    # Parse messages
+    return saved
+
+
+def ingest_message(
+    message,
+    channel_id,
+    db_conn,
+    messages_table="messages",
+    save_data="data",
+    filter_users=None,
+    download=False,
+    downloader=None,
+):
+    """Save a single message received from a `message` event
+
+    The message goes through the same filters and normalization as the messages
+    retrieved from the channel history, so both paths store the same rows. A thread
+    reply is saved with the `ts` of its parent in `parent_ts`, like the replies
+    saved by `sync_threads`.
+
+    Args:
+        message (dict): The message of the event
+        channel_id (str): The ID of the channel of the message
+        db_conn (sqlite3.Connection): The SQLite connection
+        messages_table (str): Name of the table to save the messages
+        save_data (str): The path to the folder to save the files
+        filter_users (list): A list of user IDs to filter messages by
+        download (bool): Download the PDF files attached to the message
+        downloader (AttachmentDownloader): Downloader of the attachments
+
+    Returns:
+        bool: Whether the message was saved
+    """
+    messages = _filter_messages([message], filter_users)
+    if not messages:
+        return False
+
+    pdf_files = _attach_files(messages, channel_id)
+    if download and pdf_files:
+        downloader = downloader or AttachmentDownloader(save_data)
+        downloader.download(pdf_files, db_conn)
 
-    # Create dict with additional columns
     additional_columns = {"channel_id": channel_id}
+    thread_ts = message.get("thread_ts")
+    if thread_ts and thread_ts != message.get("ts"):
+        additional_columns["parent_ts"] = thread_ts
 
-    df = structure_messages(
-        messages,
-        additional_cols=additional_columns,
+    upsert_messages(
+        db_conn,
+        [project_message(message, additional_columns) for message in messages],
+        table=messages_table,
     )
 
-    # Update database
-    df.to_sql(messages_table, db_conn, if_exists="append", index=False)
+    return True
+
 
-    return messages
+@metrics.timed("retrieve_channels")
+def retrieve_channels(
+    client,
+    channel_ids,
+    db,
+    messages_table="messages",
+    max_workers=4,
+    scheduler=None,
+    **kwargs,
+):
+    """Retrieve messages from several Slack channels concurrently
 
+    Every channel is synced by `retrieve_messages` in its own worker thread with a
+    connection borrowed from the database pool, while a single `SlackScheduler` keeps the calls of all the
+    workers under Slack's rate limits. The reload then takes about as long as the
+    slowest channel instead of the sum of all of them.
 
-def parsing_messages(conn):
-    """Parse messages using LLM"""
+    Args:
+        client (slack_sdk.WebClient): The Slack client
+        channel_ids (list): The IDs of the channels to retrieve messages from
+        db (DatabaseManager): The database of the bot
+        messages_table (str): Name of the table to save the messages
+        max_workers (int): Maximum number of channels synced at the same time
+        scheduler (SlackScheduler): Scheduler shared by the workers
+        **kwargs: Other arguments passed to `retrieve_messages`
+
+    Returns:
+        dict: The number of new messages of each channel keyed by channel ID
+    """
+    scheduler = scheduler or SlackScheduler()
+    if kwargs.get("download") and kwargs.get("downloader") is None:
+        kwargs["downloader"] = AttachmentDownloader(kwargs.get("save_data", "data"))
 
-    # Get messages from SQLite database and save them as a list
-    messages = pd.read_sql_query(
-        """SELECT text, channel_id, ts
-            FROM messages
-            WHERE ts NOT IN (SELECT ts FROM parsed_messages)
-            """,
-        conn,
+    def retrieve_channel(channel_id):
+        with db.connect() as conn:
+            return retrieve_messages(
+                client,
+                channel_id,
+                db_conn=conn,
+                messages_table=messages_table,
+                scheduler=scheduler,
+                **kwargs,
+            )
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(retrieve_channel, channel_id): channel_id
+            for channel_id in channel_ids
+        }
+        for future in tqdm(
+            as_completed(futures),
+            total=len(futures),
+            desc="Retrieving messages from channels",
+        ):
+            channel_id = futures[future]
+            try:
+                results[channel_id] = future.result()
+            except Exception as e:
+                print(f"Error retrieving {channel_id}: {e}")
+                results[channel_id] = 0
+
+    return results
+
+
+def extract_messages(
+    messages,
+    examples_path="data/examples.json",
+    max_concurrency=4,
+    cache=None,
+    packed=False,
+    pack_token_budget=3000,
+    examples_top_k=None,
+    example_token_budget=None,
+    extractor=None,
+    rule_values=None,
+):
+    """Extract the candidate data of several messages concurrently
+
+    In packed mode several emails, tagged with their `ts`, are sent in a single
+    request so the system prompt and the examples are paid once per pack. Emails
+    whose candidate can't be mapped back unambiguously are extracted one by one.
+
+    The name the candidate introduces with, found by the rule pass, replaces the one
+    of the model, and emails extracted one by one with that name are sent with the
+    reduced schema. The other values found by the rules, the email and the name of
+    the signature, are left to `_extraction_records`, which only uses them to fill
+    empty values.
+
+    Args:
+        messages (pd.DataFrame): Messages with `text`, `channel_id` and `ts` columns
+        examples_path (str): Path to the examples file used in the prompt
+        max_concurrency (int): Maximum number of LLM requests in flight
+        cache (ExtractionCache): Cache checked before calling the model
+        packed (bool): Send several emails per request
+        pack_token_budget (int): Maximum estimated tokens of the emails in a pack
+        examples_top_k (int): Add only the most similar examples to each prompt,
+            all the examples are added when None
+        example_token_budget (int): Maximum estimated tokens of the added examples
+        extractor (Extractor): Extractor to use instead of the process-wide one
+        rule_values (list): The fields found by `extract_rule_fields` in each
+            message, in order
+
+    Returns:
+        dict: A `Data` object or the raised exception keyed by `(channel_id, ts)`
+    """
+    extractor = extractor or get_extractor(
+        examples_path,
+        top_k=examples_top_k,
+        example_token_budget=example_token_budget,
     )
+    keys = list(zip(messages["channel_id"], messages["ts"]))
+    texts = messages["text"].tolist()
+    rules = {
+        key: {field: value for field, value in values.items() if field in RULE_FIELDS}
+        for key, values in zip(keys, rule_values or [{}] * len(keys))
+    }
 
-    if messages.empty:
-        print("No new messages to parse")
-        return
+    results = {}
+    if cache is not None:
+        fingerprint = extractor.fingerprint
+        for key, text in zip(keys, texts):
+            data = None if key in results else cache.get(text, fingerprint)
+            if data is not None:
+                results[key] = data
 
-    # Create a list of parsed messages
-    parsed_messages = []
-    for index, row in tqdm(
-        messages.iterrows(), total=messages.shape[0], desc="Parsing messages"
-    ):
-        try:
-            data = run_model_w_examples(row["text"], "data/examples.json")
-            df = data.data_to_pandas()
+    pending = [(key, text) for key, text in zip(keys, texts) if key not in results]
+    if packed and pending:
+        packs = pack_messages(pending, token_budget=pack_token_budget)
+
+        # Packs of a single email go through the single-message calls
+        packs = [pack for pack in packs if len(pack) > 1]
+        packed_results = extractor.batch_packed(
+            [[(str(ts), text) for (_, ts), text in pack] for pack in packs],
+            max_concurrency=max_concurrency,
+        )
+        for pack, pack_results in zip(packs, packed_results):
+            for key, text in pack:
+                data = pack_results.get(str(key[1]))
+                if data is not None:
+                    results[key] = data
+                    if cache is not None:
+                        cache.put(text, fingerprint, data)
+
+        # Fall back to single-message calls for the emails that were not mapped
+        pending = [(key, text) for key, text in pending if key not in results]
 
-            # Add columns to add context
-            df["channel_id"] = row["channel_id"]
-            df["ts"] = row["ts"]
+    # The model only extracts the other fields of the emails with the rule name
+    reduced = [
+        (key, text) for key, text in pending if set(rules[key]) >= set(RULE_FIELDS)
+    ]
+    pending = [
+        (key, text) for key, text in pending if set(rules[key]) < set(RULE_FIELDS)
+    ]
+    if reduced:
+        metrics.increment("rules.reduced", len(reduced))
+        outputs = extractor.batch_reduced(
+            [text for _, text in reduced], max_concurrency=max_concurrency
+        )
+        for (key, text), data in zip(reduced, outputs):
+            if not isinstance(data, Exception):
+                data = data.with_fields(rules[key])
+                if cache is not None:
+                    cache.put(text, fingerprint, data)
+            results[key] = data
 
-            parsed_messages.append(df)
+    if pending:
+        outputs = extractor.batch(
+            [text for _, text in pending], max_concurrency=max_concurrency
+        )
+        for (key, text), data in zip(pending, outputs):
+            results[key] = data
+            if cache is not None and not isinstance(data, Exception):
+                cache.put(text, fingerprint, data)
+
+    # Keep the order of the messages, with the name found by the rules
+    return {
+        key: (
+            results[key].with_fields(rules[key])
+            if isinstance(results[key], Data) and rules[key]
+            else results[key]
+        )
+        for key in keys
+    }
+
+
+def _extraction_records(results, rule_values):
+    """Split extraction results in `parsed_messages` records and failures
+
+    Args:
+        results (dict): The results of `extract_messages`
+        rule_values (dict): The fields found by the rule pass, keyed like `results`
+    """
+    records = []
+    failures = []
+    for (channel_id, ts), data in results.items():
+        rules = rule_values.get((channel_id, ts), {})
+        try:
+            if isinstance(data, Exception):
+                raise data
+
+            candidate = data.people[0].dict()
         except Exception as e:
             print(f"Error: {e}")
-            pass
+            failures.append((channel_id, ts, e))
+            continue
+
+        sources = {
+            field: "rule" if field in rules and field in RULE_FIELDS else "llm"
+            for field, value in candidate.items()
+            if value is not None
+        }
+
+        # The email and signature of the rules may be someone else's, they only
+        # fill a gap
+        for value, field in FALLBACK_RULE_FIELDS.items():
+            if candidate.get(field) is None and rules.get(value) is not None:
+                candidate[field] = rules[value]
+                sources[field] = "rule"
+
+        # Add columns to add context
+        record = dict(candidate, channel_id=channel_id, ts=ts)
+        record["field_sources"] = json.dumps(sources)
+
+        records.append(record)
+
+    return records, failures
+
+
+def _extraction_needed(conn, keys, candidates):
+    """Whether each message must be extracted or reuses its candidate's extraction"""
+    parsed = {
+        ts
+        for (ts,) in conn.execute(
+            f"SELECT ts FROM parsed_messages WHERE ts IN ({', '.join('?' for _ in keys)})",
+            candidates,
+        )
+    }
+
+    keep = []
+    extracting = set()
+    for (_, ts), candidate_ts in zip(keys, candidates):
+        duplicate = candidate_ts != ts and (
+            candidate_ts in parsed or candidate_ts in extracting
+        )
+        keep.append(not duplicate)
+        if not duplicate:
+            extracting.add(ts)
+
+    return keep
+
+
+@metrics.timed("parsing_messages")
+def parsing_messages(
+    conn,
+    examples_path="data/examples.json",
+    max_concurrency=4,
+    use_cache=True,
+    packed=False,
+    examples_top_k=None,
+    attachments=True,
+    attachment_token_budget=1000,
+    extractor=None,
+    classifier=None,
+    rules=True,
+    batch_size=50,
+    deduplicate=True,
+):
+    """Parse messages using LLM and save them in the `parsed_messages` table
+
+    Unparsed messages are read, extracted and saved in batches of `batch_size`
+    messages, each one committed as soon as it is done, so memory use doesn't
+    depend on the number of messages and the extractions already paid for survive
+    a crash. The spreadsheet is updated from the table by a separate stage, see
+    `send_messages_to_google_spreadsheet`.
+
+    The text of the PDFs attached to a message (e.g. the CV of the candidate), when
+    downloaded, is appended to the message text as an excerpt of at most
+    `attachment_token_budget` tokens. Messages are then pre-classified locally and
+    only the likely candidate emails are sent to the LLM; the decision is saved, so
+    the other messages are never classified or sent again.
+
+    The fields regexes can find, the name and email, are filled by a rule pass and
+    the LLM only extracts the rest. The source of each field, `rule` or `llm`, is
+    saved as JSON in the `field_sources` column.
+
+    Messages whose extraction fails are recorded in the `extraction_failures`
+    ledger and retried with an exponential backoff, up to a maximum number of
+    attempts (see `FailureLedger`).
+
+    Near-duplicate messages of the same person are linked to a single candidate
+    before the extraction (see `CandidateDeduplicator`): a message whose candidate
+    is already parsed, or is parsed in the same batch, reuses that extraction and
+    is not sent to the LLM.
+
+    Args:
+        conn (sqlite3.Connection): The SQLite connection
+        examples_path (str): Path to the examples file used in the prompt
+        max_concurrency (int): Maximum number of LLM requests in flight
+        use_cache (bool): Reuse extractions of already seen texts from the cache
+        packed (bool): Send several emails per LLM request
+        examples_top_k (int): Add only the most similar examples to each prompt
+        attachments (bool): Add the text of the downloaded PDFs to the messages
+        attachment_token_budget (int): Maximum estimated tokens of the PDF text
+        extractor (Extractor): Extractor to use instead of the process-wide one
+        classifier (MessageClassifier): Pre-classifier of the messages, the
+            heuristic one by default
+        rules (bool): Fill the name and email with the rule pass
+        batch_size (int): Number of messages extracted and committed at a time
+        deduplicate (bool): Link near-duplicate messages and extract them once
+
+    Returns:
+        int: Number of messages parsed and saved
+    """
+    if attachments:
+        extract_pdf_texts(conn)
+
+    classifier = classifier or MessageClassifier()
+    cache = ExtractionCache(conn) if use_cache else None
+    ledger = FailureLedger(conn)
+
+    dedup = None
+    if deduplicate:
+        dedup = CandidateDeduplicator(conn)
+        dedup.index_parsed()
+
+    parsed = 0
+    failed = 0
+    duplicates = 0
+    last = None
+    progress = tqdm(desc="Parsing messages", unit="msg")
+    while True:
+        # Get the next batch of messages from SQLite database. Every message
+        # selected is saved, classified out or recorded as failed, so the next
+        # batch starts after it
+        messages = select_unparsed_messages(conn, limit=batch_size, after=last)
+        if messages.empty:
+            break
+        last = (messages["ts"].iloc[-1], messages["channel_id"].iloc[-1])
+        keys = list(zip(messages["channel_id"], messages["ts"]))
+
+        # Only the excerpts of the batch are loaded
+        excerpts = (
+            attachment_excerpts(conn, keys, token_budget=attachment_token_budget)
+            if attachments
+            else {}
+        )
+        if excerpts:
+            messages["text"] = [
+                (
+                    f"{text}\n\nAttached document excerpt:\n{excerpts[key]}"
+                    if key in excerpts
+                    else text
+                )
+                for text, key in zip(messages["text"], keys)
+            ]
+
+        messages = classifier.filter_candidates(conn, messages)
+        progress.update(len(keys) - len(messages))
+        if messages.empty:
+            continue
+
+        rule_values = (
+            extract_rule_fields(messages["text"]) if rules else [{}] * len(messages)
+        )
+
+        if dedup is not None:
+            candidate_keys = list(zip(messages["channel_id"], messages["ts"]))
+            # The email of the rules may be the recipient's, it only tells people
+            # apart
+            candidates = dedup.link(
+                candidate_keys,
+                messages["text"].tolist(),
+                [
+                    {
+                        "name": values.get("name") or values.get("signature_name"),
+                        "rule_email": values.get("email"),
+                    }
+                    for values in rule_values
+                ],
+            )
+            keep = _extraction_needed(conn, candidate_keys, candidates)
+            skipped = len(keep) - sum(keep)
+            duplicates += skipped
+            progress.update(skipped)
+            messages = messages[keep]
+            rule_values = [values for values, kept in zip(rule_values, keep) if kept]
+            if messages.empty:
+                continue
+
+        results = extract_messages(
+            messages,
+            examples_path=examples_path,
+            max_concurrency=max_concurrency,
+            cache=cache,
+            packed=packed,
+            examples_top_k=examples_top_k,
+            extractor=extractor,
+            rule_values=rule_values,
+        )
+        records, failures = _extraction_records(
+            results,
+            dict(zip(zip(messages["channel_id"], messages["ts"]), rule_values)),
+        )
+
+        # Failed messages wait for their retry instead of being sent on every run
+        ledger.record(failures)
+        ledger.resolve([(record["channel_id"], record["ts"]) for record in records])
+        insert_parsed_messages(conn, records)
+
+        parsed += len(records)
+        failed += len(failures)
+        progress.update(len(messages))
+
+    progress.close()
+
+    if last is None:
+        print("No new messages to parse")
+
+    if cache is not None:
+        cache.evict()
+        print(f"Extraction cache: {cache.stats()}")
+
+    if duplicates:
+        print(f"Skipped {duplicates} duplicates of candidates already parsed")
+
+    if failed:
+        metrics.increment("extraction.failures", failed)
+        print(f"Extraction failures: {ledger.stats()}")
 
-    return parsed_messages
+    return parsed
@@ -0,0 +1,63 @@
+import pandas as pd
+
+from .schemas import FALLBACK_RULE_FIELDS, RULE_FIELDS
+
+EMAIL_PATTERN = r"([\w.+-]+@[\w-]+(?:\.[\w-]+)*\.[A-Za-z]{2,})"
+
+# Titles of the addressee, "Thank you Professor Burke" doesn't sign the email
+TITLE = r"(?:Prof(?:essor)?|Dra?|Mrs?|Ms|Sra?)\b"
+
+# A capitalized name of two to four words that doesn't start with a title, e.g.
+# "Iván Higuera-Mendieta"
+NAME = rf"(?!{TITLE})([A-ZÀ-Ý][\w'-]+(?: [A-ZÀ-Ý][\w'-]+){{1,3}})"
+
+# The candidate introducing themselves, precise enough to replace the model's name
+INTRODUCTION_PATTERN = rf"(?:[Mm]y name is|[Mm]i nombre es) {NAME}"
+
+# A sign-off alone on its line followed by the name alone on the next one, e.g.
+# "Best regards,\nJohn Smith"
+SIGNATURE_PATTERN = (
+    r"(?:^|\n)[ \t]*(?i:best(?: regards| wishes)?|kind regards|regards|sincerely"
+    r"(?: yours)?|thanks|thank you|cheers|saludos(?: cordiales)?|atentamente"
+    rf"|cordialmente|gracias)[,.!]?[ \t]*\n\s*{NAME}[ \t]*[.,]?[ \t]*(?:\n|$)"
+)
+
+
+def extract_rule_fields(texts):
+    """Fill the candidate fields that regexes find with high confidence
+
+    All the texts are matched at once with the vectorized string methods of pandas.
+    A field is only filled when it is unambiguous: the email when the text has a
+    single distinct address, and the name when the candidate introduces themselves
+    ("my name is ..."). A name alone on its line after a sign-off is returned as the
+    `signature_name`. The address may still be the recipient's and the signature
+    someone else's, so they only fill an empty value of the model
+    (`FALLBACK_RULE_FIELDS`).
+
+    Args:
+        texts (iterable): The texts of the messages
+
+    Returns:
+        list: A dict of the fields found in each text, in order, e.g.
+            `{"name": "Jane Doe", "email": "jdoe@example.com"}`
+    """
+    texts = pd.Series(list(texts), dtype="object").fillna("")
+    fields = pd.DataFrame(
+        index=texts.index,
+        columns=list(RULE_FIELDS) + list(FALLBACK_RULE_FIELDS),
+        dtype="object",
+    )
+
+    emails = texts.str.findall(EMAIL_PATTERN).map(lambda found: set(found))
+    single = emails.map(len) == 1
+    fields.loc[single, "email"] = emails[single].map(lambda found: next(iter(found)))
+
+    fields["name"] = texts.str.extract(INTRODUCTION_PATTERN, expand=False).str.strip()
+    fields["signature_name"] = texts.str.extract(
+        SIGNATURE_PATTERN, expand=False
+    ).str.strip()
+
+    return [
+        {field: value for field, value in row.items() if pd.notna(value)}
+        for row in fields.to_dict("records")
+    ]
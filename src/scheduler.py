@@ -0,0 +1,86 @@
+import threading
+import time
+
+from slack_sdk.errors import SlackApiError
+
+from .metrics import metrics
+
+
+class SlackScheduler:
+    """Schedule Slack Web API calls shared by several threads
+
+    Slack rate limits every Web API method by tier (requests per minute per
+    workspace). The scheduler spaces the calls of each method so all the threads
+    together stay under the tier limit, and when Slack still answers with a 429 it
+    pauses that method for the `Retry-After` seconds before retrying.
+    """
+
+    # Requests per minute allowed by each Slack tier
+    TIER_LIMITS = {1: 1, 2: 20, 3: 50, 4: 100}
+
+    # Tier of the methods used by the bot
+    METHOD_TIERS = {
+        "conversations.history": 3,
+        "conversations.replies": 3,
+        "chat.postMessage": 4,
+        "chat.update": 3,
+    }
+
+    def __init__(self, max_retries=5, default_tier=3):
+        self.max_retries = max_retries
+        self.default_tier = default_tier
+        self._lock = threading.Lock()
+        self._next_slot = {}
+        self._paused_until = {}
+
+    def _interval(self, method):
+        """Minimum number of seconds between two calls of a method"""
+        tier = self.METHOD_TIERS.get(method, self.default_tier)
+        return 60 / self.TIER_LIMITS[tier]
+
+    def _wait_for_slot(self, method):
+        """Reserve the next free slot of a method and sleep until it comes"""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(
+                now,
+                self._next_slot.get(method, now),
+                self._paused_until.get(method, now),
+            )
+            self._next_slot[method] = slot + self._interval(method)
+
+        if slot > now:
+            time.sleep(slot - now)
+
+    def _pause(self, method, seconds):
+        """Stop sending calls of a method for some seconds"""
+        with self._lock:
+            until = time.monotonic() + seconds
+            self._paused_until[method] = max(self._paused_until.get(method, 0), until)
+
+    def call(self, method, func, **kwargs):
+        """Call a Slack client method respecting its rate limit
+
+        Args:
+            method (str): Name of the Slack API method, e.g. `conversations.history`
+            func (callable): The client method to call
+            **kwargs: Arguments passed to `func`
+
+        Returns:
+            slack_sdk.web.SlackResponse: The response of the call
+        """
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_slot(method)
+            metrics.increment(f"slack.{method}.calls")
+            try:
+                with metrics.timer(f"slack.{method}"):
+                    return func(**kwargs)
+            except SlackApiError as e:
+                if e.response.status_code != 429 or attempt == self.max_retries:
+                    raise
+
+                metrics.increment(f"slack.{method}.retries")
+
+                headers = e.response.headers or {}
+                retry_after = headers.get("Retry-After") or headers.get("retry-after")
+                self._pause(method, int(retry_after or 1))
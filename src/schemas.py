@@ -2,7 +2,18 @@ import json
 from typing import List, Optional, TypedDict
 
 import pandas as pd
-from langchain_core.pydantic_v1 import BaseModel, Field
+from langchain_core.pydantic_v1 import BaseModel, Field, create_model
+
+# Bump when the extraction schemas change so cached extractions are not reused
+SCHEMA_VERSION = 3
+
+# Candidate fields the rule pass can fill without the LLM (see `src/rules.py`)
+RULE_FIELDS = ("name",)
+
+# Values of the rule pass that only fill a field the LLM leaves empty, with the
+# field they fill: an address in an email may be the recipient's rather than the
+# candidate's, and a signature may be someone else's
+FALLBACK_RULE_FIELDS = {"email": "email", "signature_name": "name"}
 
 
 class Candidate(BaseModel):
@@ -47,6 +58,77 @@ class Data(BaseModel):
 
         return pd.DataFrame(dict_data, index=[0])
 
+    def with_fields(self, values):
+        """Copy of the data with some fields of every candidate replaced."""
+
+        return Data(people=[person.copy(update=values) for person in self.people])
+
+
+# Candidate without the fields filled by the rule pass, asked to the LLM when the
+# rules found all of them
+ReducedCandidate = create_model(
+    "ReducedCandidate",
+    __base__=BaseModel,
+    **{
+        name: (Candidate.__annotations__[name], field.field_info)
+        for name, field in Candidate.__fields__.items()
+        if name not in RULE_FIELDS
+    },
+)
+ReducedCandidate.__doc__ = "Schema about a candidate whose name is known."
+
+
+class ReducedData(BaseModel):
+    """Extracted data about candidates whose name is known."""
+
+    people: List[ReducedCandidate]
+
+    def to_data(self):
+        """Convert to `Data`, leaving the fields filled by the rules empty."""
+
+        return Data(
+            people=[
+                Candidate(**dict.fromkeys(RULE_FIELDS), **person.dict())
+                for person in self.people
+            ]
+        )
+
+
+class TaggedCandidate(Candidate):
+    """Candidate extracted from one of several emails sent together."""
+
+    message_id: Optional[str] = Field(
+        ..., description="The id of the email the candidate was extracted from"
+    )
+
+
+class PackedData(BaseModel):
+    """Extracted data about candidates from several tagged emails."""
+
+    people: List[TaggedCandidate]
+
+    def split_by_message(self, message_ids):
+        """Map each candidate back to the email it was extracted from.
+
+        Only emails with exactly one candidate are mapped. If a candidate has an id
+        that was not requested nothing is mapped, as any candidate may be mislabeled.
+        """
+
+        message_ids = [str(message_id) for message_id in message_ids]
+        candidates = {message_id: [] for message_id in message_ids}
+        for person in self.people:
+            if person.message_id not in candidates:
+                return {}
+            candidates[person.message_id].append(person)
+
+        return {
+            message_id: Data(
+                people=[Candidate(**people[0].dict(exclude={"message_id"}))]
+            )
+            for message_id, people in candidates.items()
+            if len(people) == 1
+        }
+
 
 class Example(TypedDict):
     """A representation of an example consisting of text input and expected tool calls.
@@ -0,0 +1,242 @@
+import re
+
+# Searchable fields of the candidates, in the order of the index columns
+SEARCH_FIELDS = [
+    "name",
+    "undergraduate_institution",
+    "graduate_institution",
+    "program_major",
+    "advisor",
+    "current_workplace",
+    "current_project_name",
+    "email",
+    "overall_summary",
+]
+
+# Weight of a match in each field, names and institutions rank above summaries
+FIELD_WEIGHTS = [10.0, 5.0, 5.0, 3.0, 5.0, 3.0, 2.0, 10.0, 1.0]
+
+# A match in the raw email counts less than a match in an extracted field
+TEXT_WEIGHT = 0.5
+
+# Words of a query restricting the terms after them to some fields
+FIELD_ALIASES = {
+    "name": ["name"],
+    "email": ["email"],
+    "advisor": ["advisor"],
+    "university": ["undergraduate_institution", "graduate_institution"],
+    "institution": ["undergraduate_institution", "graduate_institution"],
+    "school": ["undergraduate_institution", "graduate_institution"],
+    "major": ["program_major"],
+    "program": ["program_major"],
+    "workplace": ["current_workplace"],
+    "work": ["current_workplace"],
+    "project": ["current_project_name"],
+}
+
+TOKEN_PATTERN = re.compile(r'"([^"]+)"|(\S+)')
+
+
+def create_search_index(conn):
+    """Create the full-text indexes of the messages and the candidates
+
+    Both are FTS5 indexes over the rows of `messages` and `parsed_messages`, kept
+    up to date by triggers on every insert, update and delete. Rows saved before the
+    index existed are indexed when it is created.
+    """
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'parsed_messages_fts'"
+    ).fetchone()
+
+    fields = ", ".join(SEARCH_FIELDS)
+    new_fields = ", ".join(f"new.{field}" for field in SEARCH_FIELDS)
+    old_fields = ", ".join(f"old.{field}" for field in SEARCH_FIELDS)
+
+    conn.executescript(
+        f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            text, content='messages', content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2'
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS parsed_messages_fts USING fts5(
+            {fields}, content='parsed_messages', content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2'
+        );
+
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text);
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text)
+            VALUES ('delete', old.rowid, old.text);
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages
+        WHEN old.text IS NOT new.text
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text)
+            VALUES ('delete', old.rowid, old.text);
+            INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS parsed_messages_fts_insert
+        AFTER INSERT ON parsed_messages
+        BEGIN
+            INSERT INTO parsed_messages_fts (rowid, {fields})
+            VALUES (new.rowid, {new_fields});
+        END;
+        CREATE TRIGGER IF NOT EXISTS parsed_messages_fts_delete
+        AFTER DELETE ON parsed_messages
+        BEGIN
+            INSERT INTO parsed_messages_fts (parsed_messages_fts, rowid, {fields})
+            VALUES ('delete', old.rowid, {old_fields});
+        END;
+        CREATE TRIGGER IF NOT EXISTS parsed_messages_fts_update
+        AFTER UPDATE ON parsed_messages
+        BEGIN
+            INSERT INTO parsed_messages_fts (parsed_messages_fts, rowid, {fields})
+            VALUES ('delete', old.rowid, {old_fields});
+            INSERT INTO parsed_messages_fts (rowid, {fields})
+            VALUES (new.rowid, {new_fields});
+        END;
+        """
+    )
+
+    if not exists:
+        conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+        conn.execute(
+            "INSERT INTO parsed_messages_fts (parsed_messages_fts) VALUES ('rebuild')"
+        )
+    conn.commit()
+
+
+def build_match_query(query):
+    """Translate a user query to an FTS5 query
+
+    Every word, or "quoted phrase", must match, and a word ending in `*` matches as
+    a prefix. A leading field name, e.g. `advisor Burke` or `university Andes`,
+    restricts the other words to that field.
+
+    Args:
+        query (str): The query typed by the user
+
+    Returns:
+        tuple: The FTS5 query, None if the query has no words, and whether it is
+            restricted to candidate fields
+    """
+    terms = []
+    for phrase, word in TOKEN_PATTERN.findall(query):
+        term = phrase or word
+        prefix = not phrase and term.endswith("*")
+        term = term.rstrip("*").replace('"', "")
+        if term:
+            terms.append('"' + term + '"' + ("*" if prefix else ""))
+
+    if not terms:
+        return None, False
+
+    fields = FIELD_ALIASES.get(terms[0].strip('"*').lower())
+    if fields and len(terms) > 1:
+        return "{" + " ".join(fields) + "} : (" + " ".join(terms[1:]) + ")", True
+
+    return " ".join(terms), False
+
+
+def search_candidates(conn, query, page=0, page_size=5):
+    """Search the candidates and the emails they were extracted from
+
+    Matches in the candidate fields and in the raw message text are ranked together
+    with BM25, weighting the fields by `FIELD_WEIGHTS`, and grouped by message.
+
+    Args:
+        conn (sqlite3.Connection): The SQLite connection
+        query (str): The query typed by the user, see `build_match_query`
+        page (int): Page of results, starting at 0
+        page_size (int): Number of results per page
+
+    Returns:
+        dict: The `total` number of messages matching and the `results` of the
+            page, each a dict with the candidate fields, `channel_name`, `ts` and a
+            `snippet` of the best match
+    """
+    match, fields_only = build_match_query(query)
+    if match is None:
+        return {"total": 0, "results": []}
+
+    weights = ", ".join(str(weight) for weight in FIELD_WEIGHTS)
+    hits = f"""
+        SELECT pm.ts AS ts, pm.channel_id AS channel_id,
+            bm25(parsed_messages_fts, {weights}) AS rank,
+            'parsed_messages' AS source, parsed_messages_fts.rowid AS row
+        FROM parsed_messages_fts
+        JOIN parsed_messages pm ON pm.rowid = parsed_messages_fts.rowid
+        WHERE parsed_messages_fts MATCH :match
+        """
+    if not fields_only:
+        hits += f"""
+        UNION ALL
+        SELECT m.ts, m.channel_id, bm25(messages_fts) * {TEXT_WEIGHT}, 'messages',
+            messages_fts.rowid
+        FROM messages_fts
+        JOIN messages m ON m.rowid = messages_fts.rowid
+        WHERE messages_fts MATCH :match
+        """
+
+    # With MIN() SQLite takes the other bare columns from the best ranked row. The
+    # hits are materialized, bm25() can't run inside the aggregate
+    rows = conn.execute(
+        f"""
+        WITH hits AS MATERIALIZED ({hits}),
+        best AS (
+            SELECT ts, channel_id, MIN(rank) AS rank, source, row
+            FROM hits
+            GROUP BY ts
+        )
+        SELECT COUNT(*) OVER () AS total, best.source, best.row, best.ts,
+            c.channel_name, pm.name, pm.email, pm.undergraduate_institution,
+            pm.graduate_institution, pm.advisor, pm.current_workplace
+        FROM best
+        LEFT JOIN parsed_messages pm ON pm.ts = best.ts
+        LEFT JOIN channels c ON c.channel_id = best.channel_id
+        ORDER BY best.rank
+        LIMIT :limit OFFSET :offset
+        """,
+        {"match": match, "limit": page_size, "offset": page * page_size},
+    ).fetchall()
+
+    if not rows:
+        return {"total": 0, "results": []}
+
+    # Snippets are only built for the results of the page
+    snippets = {}
+    for source, column in [("parsed_messages", -1), ("messages", 0)]:
+        ids = [row[2] for row in rows if row[1] == source]
+        if ids:
+            snippets.update(
+                ((source, rowid), snippet)
+                for rowid, snippet in conn.execute(
+                    f"""
+                    SELECT rowid, snippet({source}_fts, {column}, '*', '*', '…', 12)
+                    FROM {source}_fts
+                    WHERE {source}_fts MATCH ? AND rowid IN ({", ".join("?" for _ in ids)})
+                    """,
+                    [match, *ids],
+                )
+            )
+
+    columns = [
+        "ts",
+        "channel_name",
+        "name",
+        "email",
+        "undergraduate_institution",
+        "graduate_institution",
+        "advisor",
+        "current_workplace",
+    ]
+    results = [
+        dict(zip(columns, row[3:]), snippet=snippets.get((row[1], row[2])))
+        for row in rows
+    ]
+    return {"total": rows[0][0], "results": results}
@@ -0,0 +1,168 @@
+import re
+
+# SQL expression of each dimension of the summary, from a row of `parsed_messages`
+# referenced as `{row}`. Unknown values are '' so they group (NULLs never do)
+SUMMARY_DIMENSIONS = {
+    "channel_id": "COALESCE({row}.channel_id, '')",
+    # The latest institution of the candidate: graduate school, else college
+    "institution": (
+        "COALESCE(NULLIF(TRIM({row}.graduate_institution), ''), "
+        "NULLIF(TRIM({row}.undergraduate_institution), ''), '')"
+    ),
+    "quality": (
+        "CASE WHEN TRIM({row}.quality_assessment) GLOB '[0-9]*' THEN "
+        "CASE WHEN CAST(TRIM({row}.quality_assessment) AS INTEGER) >= 8 THEN 'high' "
+        "WHEN CAST(TRIM({row}.quality_assessment) AS INTEGER) >= 5 THEN 'medium' "
+        "ELSE 'low' END ELSE '' END"
+    ),
+    # Monday of the week the message was posted
+    "week": (
+        "COALESCE(date(CAST({row}.ts AS REAL), 'unixepoch', 'weekday 0', '-6 days'), '')"
+    ),
+}
+
+# Dimensions the user can group by or filter on, with their SQL expression
+SUMMARY_GROUPS = {
+    "channel": "COALESCE(c.channel_name, s.channel_id)",
+    "institution": "s.institution",
+    "quality": "s.quality",
+    "week": "s.week",
+}
+
+FILTER_PATTERN = re.compile(r'(\w+):(?:"([^"]*)"|(\S+))')
+
+
+def create_summary_table(conn):
+    """Create the table of candidate counts and the triggers maintaining it
+
+    `summary_counts` holds the number of parsed messages for each combination of
+    channel, institution, quality bucket and week. Triggers on `parsed_messages`
+    update it in the same transaction as every insert, update and delete, so
+    `/summary` reads a few rows instead of scanning the candidates. The counts of
+    rows saved before the table existed are computed when it is created.
+    """
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'summary_counts'"
+    ).fetchone()
+
+    columns = ", ".join(SUMMARY_DIMENSIONS)
+    new_keys = ", ".join(sql.format(row="new") for sql in SUMMARY_DIMENSIONS.values())
+    old_match = " AND ".join(
+        f"{column} = {sql.format(row='old')}"
+        for column, sql in SUMMARY_DIMENSIONS.items()
+    )
+    add_new = f"""
+        INSERT INTO summary_counts ({columns}, count) VALUES ({new_keys}, 1)
+        ON CONFLICT ({columns}) DO UPDATE SET count = count + 1;
+        """
+    remove_old = f"""
+        UPDATE summary_counts SET count = count - 1 WHERE {old_match};
+        DELETE FROM summary_counts WHERE count <= 0;
+        """
+
+    conn.executescript(
+        f"""
+        CREATE TABLE IF NOT EXISTS summary_counts
+        (channel_id TEXT, institution TEXT, quality TEXT, week TEXT, count INT,
+        PRIMARY KEY ({columns}));
+
+        CREATE TRIGGER IF NOT EXISTS summary_counts_insert
+        AFTER INSERT ON parsed_messages
+        BEGIN {add_new} END;
+
+        CREATE TRIGGER IF NOT EXISTS summary_counts_delete
+        AFTER DELETE ON parsed_messages
+        BEGIN {remove_old} END;
+
+        CREATE TRIGGER IF NOT EXISTS summary_counts_update
+        AFTER UPDATE OF channel_id, ts, graduate_institution,
+            undergraduate_institution, quality_assessment ON parsed_messages
+        BEGIN {remove_old} {add_new} END;
+        """
+    )
+
+    if not exists:
+        keys = ", ".join(sql.format(row="pm") for sql in SUMMARY_DIMENSIONS.values())
+        conn.execute(
+            f"""
+            INSERT INTO summary_counts ({columns}, count)
+            SELECT {keys}, COUNT(*) FROM parsed_messages pm GROUP BY {keys}
+            """
+        )
+    conn.commit()
+
+
+def parse_summary_query(text):
+    """Parse the arguments of `/summary`
+
+    The first word not followed by `:` is the dimension to group by, and
+    `dimension:value` pairs filter the counts, e.g.
+    `institution channel:graduate_students quality:high since:2024-01-01`. Values
+    with spaces are quoted, e.g. `institution:"Universidad de los Andes"`.
+
+    Args:
+        text (str): The text of the command
+
+    Returns:
+        tuple: The dimension to group by and a dict of filters
+
+    Raises:
+        ValueError: If the dimension or a filter is unknown
+    """
+    filters = {
+        key.lower(): quoted or bare
+        for key, quoted, bare in FILTER_PATTERN.findall(text)
+    }
+    words = FILTER_PATTERN.sub(" ", text).split()
+    by = words[0].lower() if words else "channel"
+
+    if by not in SUMMARY_GROUPS:
+        raise ValueError(f"Can't group by `{by}`")
+    for key in filters:
+        if key not in SUMMARY_GROUPS and key != "since":
+            raise ValueError(f"Unknown filter `{key}`")
+
+    return by, filters
+
+
+def summarize(conn, by="channel", filters=None):
+    """Count the candidates by one dimension from `summary_counts`
+
+    Args:
+        conn (sqlite3.Connection): The SQLite connection
+        by (str): Dimension to group by, one of `SUMMARY_GROUPS`
+        filters (dict): Values the other dimensions must match. `channel` and
+            `quality` match exactly, `institution` matches a part of the name,
+            `week` keeps the week of a date and `since` the weeks from a date on
+
+    Returns:
+        list: `(value, count)` of each group, the largest first
+    """
+    filters = filters or {}
+    conditions = []
+    params = []
+    for key, value in filters.items():
+        if key == "since":
+            conditions.append("s.week >= date(?, 'weekday 0', '-6 days')")
+        elif key == "week":
+            conditions.append("s.week = date(?, 'weekday 0', '-6 days')")
+        elif key == "institution":
+            conditions.append("s.institution LIKE '%' || ? || '%'")
+        else:
+            conditions.append(f"{SUMMARY_GROUPS[key]} = ?")
+        params.append(value)
+
+    group = SUMMARY_GROUPS[by]
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return conn.execute(
+        f"""
+        SELECT COALESCE(NULLIF({group}, ''), '(unknown)') AS value,
+            SUM(s.count) AS count
+        FROM summary_counts s
+        LEFT JOIN channels c ON c.channel_id = s.channel_id
+        {where}
+        GROUP BY value
+        ORDER BY count DESC, value
+        """,
+        params,
+    ).fetchall()
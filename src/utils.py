@@ -1,36 +1,98 @@
+import hashlib
 import json
+import re
+import time
 
 import gspread
 import pandas as pd
-from gspread_dataframe import set_with_dataframe
-from langchain_community.llms import Ollama
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
 from tqdm import tqdm
 
+from .metrics import metrics
 from .schemas import Candidate
 
 
-def send_messages_to_google_spreadsheet(parsed_messages, credentials, conn):
+def open_worksheet(credentials=None, spreadsheet_name="test_candidates"):
+    """Open the first worksheet of the candidates Google Spreadsheet"""
+    if credentials:
+        gc = gspread.service_account(filename=credentials)
+    else:
+        gc = gspread.service_account()
+
+    spreadsheet = gc.open(spreadsheet_name)
+    return spreadsheet.get_worksheet(0)
+
+
+def _sheets_call(func, *args, max_retries=5, **kwargs):
+    """Call the Sheets API, retrying with exponential backoff on 429 errors"""
+    for attempt in range(max_retries + 1):
+        metrics.increment("sheets.calls")
+        try:
+            with metrics.timer("sheets.call"):
+                return func(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            if e.response.status_code != 429 or attempt == max_retries:
+                raise
+
+            metrics.increment("sheets.retries")
+            time.sleep(2**attempt)
+
+
+def _sheet_values(data_tidy):
+    """Convert a data frame to JSON-friendly rows for the Sheets API"""
+    data_tidy = data_tidy.astype(object).where(pd.notna(data_tidy), "")
+    return [[str(value) for value in row] for row in data_tidy.itertuples(index=False)]
+
+
+def _row_hash(values):
+    """Hash the values of a spreadsheet row"""
+    return hashlib.sha1(json.dumps(values).encode("utf-8")).hexdigest()
+
+
+def _first_updated_row(response):
+    """Get the first row number written by an `append_rows` call"""
+    updated_range = response["updates"]["updatedRange"]
+    return int(re.search(r"![A-Z]+(\d+)", updated_range).group(1))
+
+
+@metrics.timed("send_messages_to_google_spreadsheet")
+def send_messages_to_google_spreadsheet(
+    credentials,
+    conn,
+    full_resync=False,
+    worksheet=None,
+    chunk_size=500,
+):
     """Send parsed messages to Google Spreadsheet
 
-    This function will take a list of parsed messages and send them to a Google Spreadsheet.
+    This function will read the parsed messages from the `parsed_messages` table and send them
+    to a Google Spreadsheet, so it can run, or be retried, independently of the parsing.
+    The `sheet_sync` table records the spreadsheet row and a hash of the values of every
+    `ts` already pushed, so only new rows are appended and only changed rows are updated,
+    in chunks of `chunk_size` rows per API call. A full resync clears the worksheet and
+    writes every row again, which repairs a sheet edited by hand. The first sync of a
+    database is always a full resync.
+
+    Each person has a single row, the one of their candidate message: messages linked
+    to another parsed candidate (see `CandidateDeduplicator`) are left out.
 
     Args:
-        parsed_messages (list): A list of parsed messages
         credentials (str): The path to the JSON file with the Google Service Account credentials
+        conn (sqlite3.Connection): The SQLite connection
+        full_resync (bool): Rewrite the whole worksheet instead of pushing the changes
+        worksheet (gspread.Worksheet): The worksheet to write to, opened from the
+            credentials if not given
+        chunk_size (int): Maximum number of rows sent per API call
 
     Returns:
         None
     """
 
-    # Build a data frame with the records in list
-
-    if parsed_messages is not None:
-        data = pd.concat(parsed_messages)
-
-        # Format a nice table using SQL to upload to Google Sheets
-        data.to_sql(name="parsed_messages", con=conn, if_exists="append", index=False)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sheet_sync
+        (ts TEXT PRIMARY KEY, row_number INT, row_hash TEXT, pushed_at REAL)
+        """
+    )
 
     # Send clean data to Google Spreadsheet by replacing channel_id with the channel name
     data_tidy = pd.read_sql_query(
@@ -39,24 +101,92 @@ def send_messages_to_google_spreadsheet(parsed_messages, credentials, conn):
         FROM parsed_messages pm
         LEFT JOIN channels c ON pm.channel_id = c.channel_id
         LEFT JOIN messages m ON pm.ts = m.ts
+        LEFT JOIN candidate_links l ON l.channel_id = pm.channel_id AND l.ts = pm.ts
+        WHERE l.candidate_ts IS NULL OR l.candidate_ts = pm.ts
+            OR l.candidate_ts NOT IN (SELECT ts FROM parsed_messages)
         """,
         conn,
-    )
-
-    # Transform the ts column to a datetime object and add the current processing date
-    data_tidy["ts"] = pd.to_datetime(data_tidy["ts"], unit="s")
-    data_tidy["processing_date"] = pd.to_datetime("today")
+    ).drop_duplicates(subset="ts")
+    keys = data_tidy["ts"].astype(str).tolist()
+
+    # Transform the ts column to a datetime object
+    data_tidy["ts"] = pd.to_datetime(data_tidy["ts"].astype(float), unit="s")
+    values = _sheet_values(data_tidy)
+    hashes = [_row_hash(row) for row in values]
+
+    # The processing date is not hashed, it changes on every run
+    processing_date = str(pd.to_datetime("today"))
+    header = data_tidy.columns.tolist() + ["processing_date"]
+
+    pushed = {
+        ts: (row_number, row_hash)
+        for ts, row_number, row_hash in conn.execute(
+            "SELECT ts, row_number, row_hash FROM sheet_sync"
+        )
+    }
+    full_resync = full_resync or not pushed
+
+    new_rows, changed_rows = [], []
+    for key, row, row_hash in zip(keys, values, hashes):
+        if full_resync or key not in pushed:
+            new_rows.append((key, row, row_hash))
+        elif pushed[key][1] != row_hash:
+            changed_rows.append((key, row, row_hash))
+
+    if not new_rows and not changed_rows:
+        print("Google Spreadsheet is up to date")
+        return None
 
     # Send data to Google Spreadsheet
-    if credentials:
-        gc = gspread.service_account(filename=credentials)
-    else:
-        gc = gspread.service_account()
-
-    spreadsheet = gc.open("test_candidates")
-    worksheet = spreadsheet.get_worksheet(0)
+    if worksheet is None:
+        worksheet = open_worksheet(credentials)
+
+    if full_resync:
+        _sheets_call(worksheet.clear)
+        _sheets_call(worksheet.update, range_name="A1", values=[header])
+        conn.execute("DELETE FROM sheet_sync")
+
+    synced = []
+
+    # Append the new rows
+    for start in range(0, len(new_rows), chunk_size):
+        chunk = new_rows[start : start + chunk_size]
+        response = _sheets_call(
+            worksheet.append_rows,
+            [row + [processing_date] for _, row, _ in chunk],
+            value_input_option="RAW",
+            insert_data_option="INSERT_ROWS",
+            table_range="A1",
+        )
+        first_row = _first_updated_row(response)
+        synced.extend(
+            (key, first_row + idx, row_hash)
+            for idx, (key, _, row_hash) in enumerate(chunk)
+        )
+
+    # Update the rows that changed in place
+    for start in range(0, len(changed_rows), chunk_size):
+        chunk = changed_rows[start : start + chunk_size]
+        _sheets_call(
+            worksheet.batch_update,
+            [
+                {"range": f"A{pushed[key][0]}", "values": [row + [processing_date]]}
+                for key, row, _ in chunk
+            ],
+            value_input_option="RAW",
+        )
+        synced.extend((key, pushed[key][0], row_hash) for key, _, row_hash in chunk)
+
+    conn.executemany(
+        "INSERT OR REPLACE INTO sheet_sync (ts, row_number, row_hash, pushed_at) VALUES (?, ?, ?, ?)",
+        [
+            (key, row_number, row_hash, time.time())
+            for key, row_number, row_hash in synced
+        ],
+    )
+    conn.commit()
 
-    set_with_dataframe(worksheet, data_tidy)
+    print(f"Appended {len(new_rows)} and updated {len(changed_rows)} rows")
 
     return None
 
@@ -95,6 +225,11 @@ def parse_messages(
         list: A list of parsed messages
     """
 
+    # LangChain Community is slow to import and only used here
+    from langchain_community.llms import Ollama
+    from langchain_core.output_parsers import StrOutputParser
+    from langchain_core.prompts import ChatPromptTemplate
+
     # Get messages from SQLite database and save them as a list
     messages = pd.read_sql_query(
         f"""SELECT text